@@ -2,19 +2,30 @@ from table2ascii import table2ascii as t2a, PresetStyle
 import os
 import json
 import random
+import bisect
 import asyncio
 import calendar
+import functools
+import contextlib
+import itertools
+import signal
+import sqlite3
 import threading
-from datetime import datetime, timezone, timedelta, time 
-from flask import Flask
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from datetime import date, datetime, timezone, timedelta, time 
+from aiohttp import web
+import numpy as np
 from table2ascii import table2ascii as t2a, PresetStyle
 import discord
 from discord.ext import commands, tasks
-from supabase import create_client
 
+@functools.lru_cache(maxsize=4096)
 def cut_horse_name(name: str, max_width: float = 10.0) -> str:
     """
     馬名を 10 文字相当までに制限する関数（英字/数字は 0.8 文字換算）
+    馬名は変わらないため、結果は名前ごとに覚えておく
     """
     width = 0.0
     result = []
@@ -36,48 +47,246 @@ def cut_horse_name(name: str, max_width: float = 10.0) -> str:
     return "".join(result)
 
 def get_owner(data, user_id):
-    return data["owners"].setdefault(
-        str(user_id),
-        {"balance": 0, "wins": 0, "horses": []}
-    )
+    uid = str(user_id)
+    if uid not in data["owners"]:
+        data["owners"][uid] = {"balance": 0, "wins": 0, "horses": []}
+        leaderboards(data).add_owner(uid)
+    return data["owners"][uid]
+
+def adjust_owner(data, user_id, balance=0, wins=0):
+    """オーナーの所持金・勝利数を増減し、ランキングにも反映する"""
+    uid = str(user_id)
+    owner = get_owner(data, uid)
+    owner["balance"] = owner.get("balance", 0) + balance
+    owner["wins"] = owner.get("wins", 0) + wins
+    leaderboards(data).record(uid, balance, wins)
+    return owner
+
+# ---------------- 計測（/metrics で公開） ----------------
+
+# 所要時間（秒）とデータサイズ（バイト）のヒストグラムの区切り
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+# イベントループの遅延を測る間隔と、1回の計測で待つ時間（秒）
+LOOP_LAG_INTERVAL = 5.0
+LOOP_LAG_PROBE = 0.5
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    """
+    カウンター・ゲージ・ヒストグラムをラベルごとに集計し、Prometheus のテキスト形式で出力する。
+    ストレージ呼び出しのスレッドからも更新されるため、更新と出力はロックで保護する。
+    """
 
-# ---------------- Flask (Render Health Check 用) ----------------
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """with ブロックの所要時間を name のヒストグラムに記録する"""
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - started, **labels)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for kind, series in (("counter", self._counters), ("gauge", self._gauges)):
+                for name in sorted({name for name, _ in series}):
+                    lines.append(f"# TYPE {name} {kind}")
+                    for (n, labels), value in sorted(series.items()):
+                        if n == name:
+                            lines.append(f"{name}{self._labels(labels)} {value}")
+            for name in sorted({name for name, _ in self._histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (n, labels), h in sorted(self._histograms.items(), key=lambda item: item[0]):
+                    if n != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(h.buckets, h.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {h.count}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {h.sum}")
+                    lines.append(f"{name}_count{self._labels(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+# ---------------- ヘルスチェック (Render Health Check 用) ----------------
+# Bot と同じイベントループ上で動かすため、ループが止まっていれば応答自体が返らない。
+
+# 直近の遅延の最大値をこの秒数以上になったら異常とみなす
+HEALTH_MAX_LOOP_LAG = 5.0
+# ループ遅延の最大値を取る直近の計測回数（LOOP_LAG_INTERVAL 秒ごと）
+LOOP_LAG_WINDOW = 12
+LOOP_LAG_SAMPLES = deque(maxlen=LOOP_LAG_WINDOW)
+# 最後にレース処理（定時・強制実行・追いつき）を完了した日時
+LAST_RACE_RUN = None
+
+def _isoformat(timestamp):
+    return timestamp.isoformat() if timestamp else None
+
+def health_status():
+    """死活監視用の状態。ok はゲートウェイ接続済みかつイベントループが詰まっていないこと"""
+    lag = max(LOOP_LAG_SAMPLES, default=0.0)
+    latency = bot.latency
+    ready = bot.is_ready() and not bot.is_closed()
+    return {
+        "ok": ready and lag < HEALTH_MAX_LOOP_LAG,
+        "gateway_ready": ready,
+        "gateway_latency": round(latency, 4) if latency == latency and latency != float("inf") else None,
+        "loop_lag_max": round(lag, 4),
+        "last_save": _isoformat(STATE.last_saved),
+        # 連続した保存の失敗回数（MAX_FLUSH_FAILURES 以上の間は変更を受け付けない）
+        "flush_failures": STATE.flush_failures,
+        "last_race_run": _isoformat(LAST_RACE_RUN),
+        # 定時レースを最後に実施した開催日（実施記録より）
+        "last_race_date": STATE.data["journal"]["last_run"] if STATE.data is not None else None,
+    }
 
-app = Flask(__name__)
+async def health(request):
+    status = health_status()
+    return web.json_response(status, status=200 if status["ok"] else 503)
 
-@app.route("/")
-def health():
-    return "ok", 200
+async def metrics(request):
+    return web.Response(body=METRICS.render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
 
-def run_flask():
-    port = int(os.environ.get("PORT", 10000))
-    app.run(host="0.0.0.0", port=port)
+async def start_health_server():
+    """ヘルスチェック・メトリクス用のHTTPサーバーを起動し、停止用の runner を返す"""
+    app = web.Application()
+    app.router.add_get("/", health)
+    app.router.add_get("/metrics", metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", int(os.environ.get("PORT", 10000))).start()
+    return runner
 
 # --------------- 基本設定 ---------------
 
 intents = discord.Intents.default()
 intents.message_content = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+class RacingBot(commands.Bot):
+    health_runner = None
+    shutdown_task = None
+
+    async def on_command_error(self, ctx, error):
+        if isinstance(getattr(error, "original", error), StateUnavailable):
+            await ctx.reply("⚠️ データの保存に失敗しているため、現在は変更を受け付けていません。しばらくしてから再度お試しください。")
+            return
+        await super().on_command_error(ctx, error)
+
+    async def setup_hook(self):
+        # ログイン前に、Bot のイベントループ上でヘルスチェックを起動する
+        self.health_runner = await start_health_server()
+        # Render などは停止時に SIGTERM を送るので、Ctrl-C と同じく close() で保存してから終了する
+        # （Windows のイベントループはシグナルハンドラに対応していない）
+        with contextlib.suppress(NotImplementedError):
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, self._on_sigterm)
+
+    def _on_sigterm(self):
+        print("Received SIGTERM, shutting down")
+        if self.shutdown_task is None:
+            self.shutdown_task = asyncio.create_task(self.close())
+
+    async def invoke(self, ctx):
+        # 流量制限を超えたコマンドはここで捨てる
+        if ctx.command is not None:
+            admitted, notify = ADMISSION.admit(ctx)
+            if not admitted:
+                METRICS.inc("racing_commands_rejected_total", command=ctx.command.name)
+                if notify:
+                    await ctx.reply("⏳ コマンドの実行が集中しています。少し待ってから再度お試しください。")
+                return
+            with METRICS.timer("racing_command_seconds", command=ctx.command.name):
+                await super().invoke(ctx)
+            return
+        await super().invoke(ctx)
+
+    async def close(self):
+        # 終了前に未保存の状態を書き込む
+        try:
+            await STATE.flush()
+        finally:
+            if self.health_runner is not None:
+                await self.health_runner.cleanup()
+            await super().close()
+
+bot = RacingBot(command_prefix="!", intents=intents)
 
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 
-if not SUPABASE_URL or not SUPABASE_KEY:
-    raise RuntimeError("SUPABASE_URL or SUPABASE_KEY is not set")
-
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+# 保存先: "supabase"（既定） / "sqlite" / "memory"
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "supabase")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "racing.db")
 
+# 旧形式（全データを1行に保存していた頃）のキー
 DATA_KEY = "racing_data"
+# 新形式ではエンティティごとに "racing_data:<種別>[:<ID>]" の行に分割して保存する
+ROW_PREFIX = DATA_KEY + ":"
 
 JST = timezone(timedelta(hours=9))
 
 # 2段階認証用の待機状態を保持 (ファイルには保存しないインメモリデータ)
 PENDING_RESETS = {}
 
+# 起動時の不要データ掃除を実行済みかどうか（再接続時に繰り返さない）
+STATE_COMPACTED = False
+
 # 自動レース時刻と事前告知時刻
 RACE_TIME_JST = time(hour=19, minute=0, tzinfo=JST)
 PRE_ANNOUNCE_TIME_JST = time(hour=18, minute=0, tzinfo=JST) 
+# 停止中に過ぎた開催日を起動時にまとめて実施する上限日数（これより古い分は実施しない）
+MAX_CATCHUP_DAYS = 7
 
 # Bot馬用のオーナーID (DiscordのUIDとは異なる、集計用の特殊ID)
 BOT_OWNER_ID = "0" 
@@ -100,62 +309,1221 @@ MIN_G1_FIELD = 18
 # GⅠが開催される最大の日数（週数）
 MAX_G1_DAY = 30 
 
-async def load_data():
-    default_data = {
+# 保存要求をまとめるまでの待ち時間（秒）
+SAVE_DEBOUNCE_SECONDS = 2.0
+# 保存がこの回数続けて失敗したら、保存できるようになるまで状態の変更を受け付けない
+MAX_FLUSH_FAILURES = 3
+
+def default_data():
+    data = {
         "horses": {},
         "owners": {},
-        "races": [],
         "schedule": default_schedule(),
-        "rankings": {"prize": {}, "wins": {}, "stable": {}},
+        "rankings": {},
         "announce_channel": None,
-        "pending_entries": {}
+        "pending_entries": {},
+        # 定時レースの実施記録（最後に実施した開催日と、処理途中のレース）
+        "journal": {"last_run": None, "runs": []}
     }
 
     today = datetime.now(JST)
-    default_data["season"] = {
+    data["season"] = {
         "year": today.year,
         "month": today.month,
         "day": today.day
     }
+    return data
 
-    # Supabaseからデータを取得
-    res = supabase.table("kv_store").select("value").eq("key", DATA_KEY).execute()
+# ストレージ呼び出しの同時実行数・タイムアウト・再試行設定
+DB_MAX_CONCURRENCY = 4
+DB_TIMEOUT_SECONDS = 10.0
+DB_MAX_RETRIES = 3
+DB_RETRY_BASE_DELAY = 0.5
 
-    if not res.data:
-        # データがない場合はデフォルトデータを挿入
-        supabase.table("kv_store").insert({
-            "key": DATA_KEY,
-            "value": default_data
+# 同期クライアントをイベントループの外で動かすための専用スレッドプール
+_db_executor = ThreadPoolExecutor(max_workers=DB_MAX_CONCURRENCY, thread_name_prefix="storage")
+_db_semaphore = asyncio.Semaphore(DB_MAX_CONCURRENCY)
+
+async def run_db(call):
+    """
+    ストレージ呼び出し（STORAGE のメソッドを呼ぶ同期関数）を専用スレッドで実行する。
+    タイムアウトや通信エラー時は指数バックオフで再試行し、最後の例外を送出する。
+    """
+    loop = asyncio.get_running_loop()
+    for attempt in range(DB_MAX_RETRIES + 1):
+        try:
+            async with _db_semaphore:
+                return await asyncio.wait_for(loop.run_in_executor(_db_executor, call), DB_TIMEOUT_SECONDS)
+        except Exception as e:
+            if attempt >= DB_MAX_RETRIES:
+                raise
+            delay = DB_RETRY_BASE_DELAY * (2 ** attempt) * random.uniform(0.8, 1.2)
+            METRICS.inc("racing_storage_retries_total")
+            print(f"Storage request failed ({e!r}), retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+# ---------------- ストレージ ----------------
+# どの実装も key → JSON値 の単純なKVストアとして扱う。
+# メソッドは同期処理で、run_db() 経由でスレッドから呼ぶ。
+#   get(key)                                   値（なければ None）
+#   scan(prefix, offset, limit, desc)          [(キー, 値), ...]（キー順）
+#   upsert({キー: 値})
+#   delete([キー])
+#   delete_prefix(prefix)
+#   commit(rev_key, rev, {キー: 値}, [キー])   rev_key の行が {"rev": rev} のときだけ、書き込み・削除と
+#                                              rev + 1 への更新を1つのトランザクションで行い True を返す
+
+class SupabaseStorage:
+    """
+    Supabase の kv_store テーブル。
+    commit() はリビジョンの確認と行の書き込みを1トランザクションで行う関数 racing_commit を呼ぶ。
+    関数は supabase/migrations/ のマイグレーションで作成しておくこと（起動時に存在を確認する）。
+    """
+
+    def __init__(self, client, table="kv_store"):
+        self._client = client
+        self._table = table
+
+    def _query(self):
+        return self._client.table(self._table)
+
+    def get(self, key):
+        res = self._query().select("value").eq("key", key).execute()
+        return res.data[0]["value"] if res.data else None
+
+    def scan(self, prefix, offset=0, limit=None, desc=False):
+        query = self._query().select("key,value").like("key", prefix + "%").order("key", desc=desc)
+        if limit is not None:
+            query = query.range(offset, offset + limit - 1)
+        return [(r["key"], r["value"]) for r in query.execute().data]
+
+    def upsert(self, rows):
+        self._query().upsert([{"key": k, "value": v} for k, v in rows.items()]).execute()
+
+    def delete(self, keys):
+        self._query().delete().in_("key", list(keys)).execute()
+
+    def delete_prefix(self, prefix):
+        self._query().delete().like("key", prefix + "%").execute()
+
+    def commit(self, rev_key, rev, rows, deletes):
+        res = self._client.rpc("racing_commit", {
+            "rev_key": rev_key,
+            "expected": rev,
+            "upserts": rows,
+            "deletes": list(deletes),
         }).execute()
-        return default_data
+        return bool(res.data)
 
-    data = res.data[0]["value"]
 
-    # 既存互換処理
-    if "pending_entries" not in data:
-        data["pending_entries"] = {}
-    if "announce_channel" not in data:
-        data["announce_channel"] = None
+def _prefix_bounds(prefix):
+    """前方一致をキーの範囲検索に直す（LIKE の _ や % を気にせず索引が効く）"""
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
 
-    return data
+class SQLiteStorage:
+    """
+    同一ホスト上の SQLite ファイル（WALモード）。
+    接続は1つをロックで共有し、書き込みはメソッド単位のトランザクションにする。
+    """
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS kv_store (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def _write(self, sql, params_seq):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                cur = self._conn.executemany(sql, params_seq)
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return cur.rowcount
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM kv_store WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def scan(self, prefix, offset=0, limit=None, desc=False):
+        sql = "SELECT key, value FROM kv_store"
+        params = []
+        if prefix:
+            sql += " WHERE key >= ? AND key < ?"
+            params += _prefix_bounds(prefix)
+        sql += " ORDER BY key DESC" if desc else " ORDER BY key"
+        sql += " LIMIT ? OFFSET ?"
+        params += [-1 if limit is None else limit, offset]
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def upsert(self, rows):
+        self._write(
+            "INSERT INTO kv_store (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            [(k, json.dumps(v, ensure_ascii=False)) for k, v in rows.items()]
+        )
+
+    def delete(self, keys):
+        self._write("DELETE FROM kv_store WHERE key = ?", [(k,) for k in keys])
+
+    def delete_prefix(self, prefix):
+        self._write("DELETE FROM kv_store WHERE key >= ? AND key < ?", [_prefix_bounds(prefix)])
+
+    def commit(self, rev_key, rev, rows, deletes):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                updated = self._conn.execute(
+                    "UPDATE kv_store SET value = ? WHERE key = ? AND json_extract(value, '$.rev') = ?",
+                    (json.dumps({"rev": rev + 1}), rev_key, rev)
+                ).rowcount
+                if updated:
+                    self._conn.executemany(
+                        "INSERT INTO kv_store (key, value) VALUES (?, ?) "
+                        "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                        [(k, json.dumps(v, ensure_ascii=False)) for k, v in rows.items()]
+                    )
+                    self._conn.executemany("DELETE FROM kv_store WHERE key = ?", [(k,) for k in deletes])
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return updated > 0
+
+
+class MemoryStorage:
+    """プロセス内の dict（テスト・シミュレーション用。値はJSON文字列で持ち、参照を共有しない）"""
+
+    def __init__(self):
+        self._rows = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._rows.get(key)
+        return None if value is None else json.loads(value)
+
+    def scan(self, prefix, offset=0, limit=None, desc=False):
+        with self._lock:
+            keys = sorted((k for k in self._rows if k.startswith(prefix)), reverse=desc)
+            keys = keys[offset:] if limit is None else keys[offset:offset + limit]
+            return [(k, json.loads(self._rows[k])) for k in keys]
+
+    def upsert(self, rows):
+        encoded = {k: json.dumps(v, ensure_ascii=False) for k, v in rows.items()}
+        with self._lock:
+            self._rows.update(encoded)
+
+    def delete(self, keys):
+        with self._lock:
+            for key in keys:
+                self._rows.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for key in [k for k in self._rows if k.startswith(prefix)]:
+                del self._rows[key]
+
+    def commit(self, rev_key, rev, rows, deletes):
+        encoded = {k: json.dumps(v, ensure_ascii=False) for k, v in rows.items()}
+        with self._lock:
+            current = self._rows.get(rev_key)
+            if current is None or json.loads(current).get("rev") != rev:
+                return False
+            self._rows.update(encoded)
+            for key in deletes:
+                self._rows.pop(key, None)
+            self._rows[rev_key] = json.dumps({"rev": rev + 1})
+            return True
+
+
+# 起動時に connect_storage() で作成する
+STORAGE = None
+
+class MeteredStorage:
+    """ストレージの各メソッドの所要時間（スレッド上での往復時間）を記録するラッパー"""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __getattr__(self, name):
+        method = getattr(self.backend, name)
+        if not callable(method):
+            return method
+
+        def call(*args, **kwargs):
+            with METRICS.timer("racing_storage_seconds", op=name):
+                return method(*args, **kwargs)
+        return call
+
+def connect_storage(backend=None):
+    """設定（STORAGE_BACKEND）に従ってストレージを作成する"""
+    global STORAGE
+    backend = backend or STORAGE_BACKEND
+    if backend == "supabase":
+        if not SUPABASE_URL or not SUPABASE_KEY:
+            raise RuntimeError("SUPABASE_URL or SUPABASE_KEY is not set")
+        # SQLite・メモリで動かす場合は supabase パッケージがなくてもよい
+        from supabase import create_client
+        STORAGE = SupabaseStorage(create_client(SUPABASE_URL, SUPABASE_KEY))
+    elif backend == "sqlite":
+        STORAGE = SQLiteStorage(SQLITE_PATH)
+    elif backend == "memory":
+        STORAGE = MemoryStorage()
+    else:
+        raise RuntimeError(f"Unknown STORAGE_BACKEND: {backend}")
+    STORAGE = MeteredStorage(STORAGE)
+    _check_commit()
+    return STORAGE
+
+def _check_commit():
+    """
+    保存に使う commit() が呼べることを起動時に確認する。
+    ありえないリビジョンを指定するので何も書き込まれない。呼べない場合（Supabase に
+    racing_commit 関数がないなど）は、メモリ上にしか残らない変更を受け付ける前にここで止める。
+    """
+    try:
+        STORAGE.commit(REV_KEY, -1, {}, [])
+    except Exception as e:
+        raise RuntimeError(
+            f"Storage commit check failed; apply supabase/migrations/ before starting the bot: {e}"
+        ) from e
+
+# 書き込みの楽観的排他に使うリビジョン行
+REV_KEY = ROW_PREFIX + "rev"
+# リビジョン競合時にリモートの変更を取り込んで再試行する回数
+MAX_CONFLICT_RETRIES = 5
+
+# 1回のリクエストで読み書きする最大行数
+DB_PAGE_SIZE = 1000
+DB_WRITE_BATCH = 500
+
+# エンティティごとに1行ずつ保存するトップレベルキーと、その行種別
+ENTITY_ROW_KINDS = {
+    "horses": "horse",
+    "owners": "owner",
+    "pending_entries": "entries",
+    "bets": "bets",
+    # シーズン（年-月）ごとのランキング集計
+    "rankings": "ranking",
+}
+# エンティティのコレクションを差し替えたときに破棄する派生索引
+# （EntryBook は馬のオーナーを、HorseIndex は EntryBook を参照する。bets に依存する索引はない）
+INDEXES_BY_KEY = {
+    "horses": ("horses", "entries"),
+    "pending_entries": ("entries", "horses"),
+    "owners": ("leaderboards",),
+    "rankings": ("leaderboards",),
+}
+# 単独の行として保存するトップレベルキー
+# （"races" はレース結果アーカイブ導入前の形式。起動時にアーカイブへ移して削除する）
+SINGLE_ROW_KEYS = ["season", "races", "journal"]
+# 上記以外（スケジュール・告知チャンネルなど）はまとめて meta 行に保存する
+META_ROW = "meta"
+
+def split_rows(data):
+    """状態dictを {行キー: JSON文字列} に分解する"""
+    rows = {}
+    meta = {}
+    for top_key, value in data.items():
+        if top_key in ENTITY_ROW_KINDS:
+            kind = ENTITY_ROW_KINDS[top_key]
+            for ident, item in value.items():
+                rows[f"{ROW_PREFIX}{kind}:{ident}"] = json.dumps(item, ensure_ascii=False)
+        elif top_key in SINGLE_ROW_KEYS:
+            rows[ROW_PREFIX + top_key] = json.dumps(value, ensure_ascii=False)
+        else:
+            meta[top_key] = value
+    rows[ROW_PREFIX + META_ROW] = json.dumps(meta, ensure_ascii=False)
+    return rows
+
+def join_rows(rows):
+    """split_rows で分解した行（値はデコード済み）から状態dictを組み立てる"""
+    data = default_data()
+    for top_key in ENTITY_ROW_KINDS:
+        data[top_key] = {}
+    kinds = {kind: top_key for top_key, kind in ENTITY_ROW_KINDS.items()}
+
+    for key, value in rows.items():
+        name = key[len(ROW_PREFIX):]
+        kind, _, ident = name.partition(":")
+        if kind in kinds and ident:
+            data[kinds[kind]][ident] = value
+        elif name == META_ROW:
+            # 旧形式の meta 行に含まれていた未使用の rankings などは読み捨てる
+            data.update({k: v for k, v in value.items() if k not in ENTITY_ROW_KINDS})
+        elif name in SINGLE_ROW_KEYS:
+            data[name] = value
+    return RacingState(data)
+
+# ---------------- 変更追跡 ----------------
+
+def _track(value, mark):
+    """dict/list を変更追跡付きの型に包む（それ以外はそのまま返す）"""
+    if isinstance(value, dict):
+        return TrackedDict(mark, value)
+    if isinstance(value, list):
+        return TrackedList(mark, value)
+    return value
+
+class TrackedDict(dict):
+    """変更されると mark() を呼ぶdict（入れ子の値も追跡する）"""
+
+    def __init__(self, mark, items=()):
+        super().__init__()
+        self._mark = mark
+        for k, v in dict(items).items():
+            dict.__setitem__(self, k, _track(v, mark))
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, _track(value, self._mark))
+        self._mark()
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._mark()
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def pop(self, key, *default):
+        if key in self:
+            self._mark()
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        self._mark()
+        return dict.popitem(self)
+
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).items():
+            self[k] = v
+
+    def clear(self):
+        dict.clear(self)
+        self._mark()
+
+class TrackedList(list):
+    """変更されると mark() を呼ぶlist（入れ子の値も追跡する）"""
+
+    def __init__(self, mark, items=()):
+        super().__init__(_track(v, mark) for v in items)
+        self._mark = mark
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = [_track(v, self._mark) for v in value]
+        else:
+            value = _track(value, self._mark)
+        list.__setitem__(self, index, value)
+        self._mark()
+
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        self._mark()
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def append(self, value):
+        list.append(self, _track(value, self._mark))
+        self._mark()
+
+    def extend(self, values):
+        list.extend(self, [_track(v, self._mark) for v in values])
+        self._mark()
+
+    def insert(self, index, value):
+        list.insert(self, index, _track(value, self._mark))
+        self._mark()
+
+    def remove(self, value):
+        list.remove(self, value)
+        self._mark()
+
+    def pop(self, *index):
+        value = list.pop(self, *index)
+        self._mark()
+        return value
+
+    def clear(self):
+        list.clear(self)
+        self._mark()
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self._mark()
+
+    def reverse(self):
+        list.reverse(self)
+        self._mark()
+
+class EntityMap(TrackedDict):
+    """
+    horses / owners などエンティティ単位で行を持つコレクション。
+    キーごとに別の行として変更を記録する。
+    """
+
+    def __init__(self, state, kind, items=()):
+        self._state = state
+        self._kind = kind
+        super().__init__(None, {})
+        for k, v in dict(items).items():
+            dict.__setitem__(self, k, _track(v, self._row_mark(k)))
+
+    def _row_key(self, ident):
+        return f"{ROW_PREFIX}{self._kind}:{ident}"
+
+    def _row_mark(self, ident):
+        key = self._row_key(ident)
+        return lambda: self._state.dirty_rows.add(key)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, _track(value, self._row_mark(key)))
+        self._state.dirty_rows.add(self._row_key(key))
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._state.dirty_rows.add(self._row_key(key))
+
+    def pop(self, key, *default):
+        if key in self:
+            self._state.dirty_rows.add(self._row_key(key))
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self._state.dirty_rows.add(self._row_key(key))
+        return key, value
+
+    def clear(self):
+        self._state.dirty_rows.update(self._row_key(k) for k in self)
+        dict.clear(self)
+
+class RacingState(dict):
+    """
+    変更追跡付きの状態dict。
+    コマンドが変更した行（馬・オーナー・日別エントリー・日別ベットなど）を
+    dirty_rows に記録し、保存時にはその行だけを書き込む。
+    """
+
+    def __init__(self, data=()):
+        super().__init__()
+        self.dirty_rows = set()
+        # 保存しない派生索引（エントリー表など）。元データが差し替えられたら破棄する
+        self.indexes = {}
+        for k, v in dict(data).items():
+            self[k] = v
+        self.dirty_rows.clear()
+
+    def _top_mark(self, top_key):
+        if top_key in SINGLE_ROW_KEYS:
+            key = ROW_PREFIX + top_key
+        else:
+            key = ROW_PREFIX + META_ROW
+        return lambda: self.dirty_rows.add(key)
+
+    def __setitem__(self, top_key, value):
+        if top_key in ENTITY_ROW_KINDS:
+            kind = ENTITY_ROW_KINDS[top_key]
+            if isinstance(value, EntityMap) and value._state is self and value._kind == kind:
+                # 同じコレクションの再代入（変更は既に記録済み）
+                dict.__setitem__(self, top_key, value)
+                return
+            old = dict.get(self, top_key)
+            if old:
+                old.clear()
+            value = EntityMap(self, kind, value)
+            for name in INDEXES_BY_KEY.get(top_key, ()):
+                self.indexes.pop(name, None)
+            self.dirty_rows.update(value._row_key(k) for k in value)
+        else:
+            mark = self._top_mark(top_key)
+            value = _track(value, mark)
+            mark()
+        dict.__setitem__(self, top_key, value)
+
+    def __delitem__(self, top_key):
+        self[top_key] = {} if top_key in ENTITY_ROW_KINDS else None
+        dict.__delitem__(self, top_key)
+
+    def setdefault(self, top_key, default=None):
+        if top_key not in self:
+            self[top_key] = default
+        return dict.__getitem__(self, top_key)
+
+    def pop(self, top_key, *default):
+        if top_key in self:
+            value = self[top_key]
+            del self[top_key]
+            return value
+        return dict.pop(self, top_key, *default)
+
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).items():
+            self[k] = v
+
+    def take_dirty(self):
+        """記録済みの変更行を取り出してリセットする"""
+        dirty = self.dirty_rows
+        self.dirty_rows = set()
+        return dirty
+
+    def apply_row(self, key, value):
+        """
+        リモートで更新された行を変更として記録せずに取り込む。
+        value が None の場合は行を削除する。
+        """
+        dirty = set(self.dirty_rows)
+        self.indexes.clear()
+        name = key[len(ROW_PREFIX):]
+        if name == META_ROW:
+            for k in [k for k in self if k not in ENTITY_ROW_KINDS and k not in SINGLE_ROW_KEYS]:
+                if value is None or k not in value:
+                    del self[k]
+            self.update(value or {})
+        elif name in SINGLE_ROW_KEYS:
+            if value is None:
+                self.pop(name, None)
+            else:
+                self[name] = value
+        else:
+            kind, _, ident = name.partition(":")
+            for top_key, k in ENTITY_ROW_KINDS.items():
+                if k == kind and ident:
+                    collection = self.setdefault(top_key, {})
+                    if value is None:
+                        collection.pop(ident, None)
+                    else:
+                        collection[ident] = value
+        self.dirty_rows = dirty
+
+    def row_json(self, key):
+        """行キーに対応する現在の値をJSON文字列で返す（行が存在しなければNone）"""
+        name = key[len(ROW_PREFIX):]
+        if name == META_ROW:
+            meta = {k: v for k, v in self.items()
+                    if k not in ENTITY_ROW_KINDS and k not in SINGLE_ROW_KEYS}
+            return json.dumps(meta, ensure_ascii=False)
+        if name in SINGLE_ROW_KEYS:
+            if name not in self:
+                return None
+            return json.dumps(self[name], ensure_ascii=False)
+        kind, _, ident = name.partition(":")
+        for top_key, k in ENTITY_ROW_KINDS.items():
+            if k == kind:
+                collection = self.get(top_key, {})
+                if ident not in collection:
+                    return None
+                return json.dumps(collection[ident], ensure_ascii=False)
+        return None
+
+async def _select_rows():
+    """racing_data: で始まる全行をページングしながら取得する"""
+    rows = {}
+    start = 0
+    while True:
+        page = await run_db(lambda: STORAGE.scan(ROW_PREFIX, start, DB_PAGE_SIZE))
+        rows.update(page)
+        if len(page) < DB_PAGE_SIZE:
+            return rows
+        start += DB_PAGE_SIZE
+
+async def _upsert_rows(rows):
+    items = list(rows.items())
+    for i in range(0, len(items), DB_WRITE_BATCH):
+        batch = dict(items[i:i + DB_WRITE_BATCH])
+        await run_db(lambda: STORAGE.upsert(batch))
+
+async def _delete_rows(keys):
+    keys = list(keys)
+    for i in range(0, len(keys), DB_WRITE_BATCH):
+        batch = keys[i:i + DB_WRITE_BATCH]
+        await run_db(lambda: STORAGE.delete(batch))
+
+async def _fetch_data():
+    """
+    状態を読み込み、(data, 保存済み行の {キー: JSON文字列}, リビジョン) を返す。
+    分割形式の行がなく旧形式の1行データがある場合は、分割形式へ1度だけ移行する。
+    """
+    rows, rev_row = await _select_state()
+    if rows:
+        data = join_rows(rows)
+        if rev_row is None:
+            # リビジョン導入前のデータ
+            await _init_revision()
+            return data, split_rows(data), 0
+        return data, split_rows(data), rev_row.get("rev", 0)
+
+    # 旧形式からの互換読み込み
+    legacy = await run_db(lambda: STORAGE.get(DATA_KEY))
+    if legacy is not None:
+        # 既存互換処理（旧形式にないキーは既定値で補う）
+        data = default_data()
+        data.update(legacy)
+        # 旧形式の rankings は使われていなかった
+        data["rankings"] = {}
+        migrating = True
+    else:
+        # データがない場合はデフォルトデータを挿入
+        data = default_data()
+        migrating = False
+
+    data = RacingState(data)
+    new_rows = split_rows(data)
+    await _upsert_rows({k: json.loads(v) for k, v in new_rows.items()})
+    if migrating:
+        # 新形式の書き込みが完了してから旧形式の行を削除する
+        await run_db(lambda: STORAGE.delete([DATA_KEY]))
+        print(f"Migrated {DATA_KEY} to {len(new_rows)} rows")
+    await _init_revision()
+    return data, new_rows, 0
+
+async def _init_revision():
+    await run_db(lambda: STORAGE.upsert({REV_KEY: {"rev": 0}}))
+
+async def _select_state():
+    """
+    (状態の行 {キー: 値}, リビジョン) を返す。
+    リビジョンを先に読むため、行の読み取り中に他のプロセスが書き込んでいた場合は
+    そのリビジョンでの commit が失敗し、読み直すことになる。
+    """
+    rev_row = await run_db(lambda: STORAGE.get(REV_KEY))
+    rows = await _select_rows()
+    rows.pop(REV_KEY, None)
+    return rows, rev_row
+
+async def _store_data(data, persisted, rev):
+    """
+    前回保存時から変化した行の書き込み・消えた行の削除と、リビジョンの rev → rev + 1 を
+    1回の commit で行い、(新しい保存済み行マップ, 保存済み行の合計バイト数の増減) を返す。
+    他のプロセスが先にリビジョンを進めていた場合は何も書かずに None を返す。
+    """
+    # ループ上で文字列化しておき、別スレッドで送信中に変更されないようにする
+    if isinstance(data, RacingState):
+        # 変更追跡済みの行だけをシリアライズする
+        dirty = data.take_dirty()
+        rows = dict(persisted)
+        for key in dirty:
+            value = data.row_json(key)
+            if value is None:
+                rows.pop(key, None)
+            else:
+                rows[key] = value
+    else:
+        rows = split_rows(data)
+        dirty = set(rows) | set(persisted)
+
+    changed = {k: json.loads(rows[k]) for k in dirty if k in rows and persisted.get(k) != rows[k]}
+    removed = [k for k in dirty if k not in rows and k in persisted]
+
+    # 書き込み量（肥大化の監視用）。状態全体の大きさは変化した行の分だけ増減させる
+    write_bytes = sum(len(rows[k].encode()) for k in changed)
+    METRICS.observe("racing_state_write_bytes", write_bytes, buckets=SIZE_BUCKETS)
+    size_delta = write_bytes - sum(len(persisted[k].encode()) for k in (*changed, *removed) if k in persisted)
+
+    try:
+        committed = await run_db(lambda: STORAGE.commit(REV_KEY, rev, changed, removed))
+    except Exception:
+        committed = False
+        raise
+    finally:
+        if not committed and isinstance(data, RacingState):
+            # 書けなかった行は次回の保存で再送する
+            data.dirty_rows |= dirty
+    return (rows, size_delta) if committed else None
+
+async def _delete_data():
+    for prefix in (ROW_PREFIX, RESULTS_PREFIX, HISTORY_PREFIX):
+        await run_db(lambda: STORAGE.delete_prefix(prefix))
+    await run_db(lambda: STORAGE.delete([DATA_KEY]))
+
+
+class StateCache:
+    """
+    メモリ上に保持する正本の状態。
+    起動後最初のアクセスで1度だけ読み込み、以降の読み取りはメモリから返す。
+    書き込みはデバウンスして、まとめて1回だけストレージへ反映する。
+    """
+
+    def __init__(self):
+        self.data = None
+        # 最後に保存した各行のJSON文字列（差分書き込み用）
+        self._rows = {}
+        # 最後に読み書きした時点のリビジョン
+        self.rev = 0
+        # 保存済み行の合計バイト数（監視用。全行を数え直さずに増減で追う）
+        self.size = 0
+        self._dirty = False
+        self._flush_task = None
+        self._load_lock = asyncio.Lock()
+        self._flush_lock = asyncio.Lock()
+        # 最後に保存に成功した日時（ヘルスチェック用）
+        self.last_saved = None
+        # 連続して保存に失敗した回数（成功すると 0 に戻る）
+        self.flush_failures = 0
+
+    async def get(self):
+        if self.data is None:
+            async with self._load_lock:
+                if self.data is None:
+                    with METRICS.timer("racing_state_load_seconds"):
+                        self.data, self._rows, self.rev = await _fetch_data()
+                    self.size = sum(len(value.encode()) for value in self._rows.values())
+                    self._report_size()
+        return self.data
+
+    def _report_size(self):
+        METRICS.set("racing_state_bytes", self.size)
+        METRICS.set("racing_state_rows", len(self._rows))
+
+    def mark_dirty(self):
+        """変更を記録し、まだ予約されていなければ遅延保存を予約する"""
+        self._dirty = True
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        while True:
+            await asyncio.sleep(SAVE_DEBOUNCE_SECONDS)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Failed to flush racing data: {e}")
+            # 書き込み中に発生した変更や失敗した変更は次の周期で保存する
+            if not self._dirty:
+                return
+
+    async def flush(self):
+        """未保存の変更があれば即座に書き込む"""
+        async with self._flush_lock:
+            if self.data is None or not (self._dirty or getattr(self.data, "dirty_rows", None)):
+                return
+            self._dirty = False
+            try:
+                with METRICS.timer("racing_state_flush_seconds"):
+                    await self._commit()
+                self.last_saved = datetime.now(JST)
+                self.flush_failures = 0
+            except Exception:
+                self._dirty = True
+                self.flush_failures += 1
+                METRICS.inc("racing_state_flush_failures_total")
+                if self.flush_failures == MAX_FLUSH_FAILURES:
+                    print(f"Racing data could not be saved {MAX_FLUSH_FAILURES} times in a row; refusing changes until it can")
+                raise
+            finally:
+                METRICS.set("racing_state_flush_failures", self.flush_failures)
+
+    async def ensure_writable(self):
+        """
+        保存の失敗が続いている場合は、未保存の変更の書き込みを試し、
+        まだ書き込めなければ StateUnavailable を送出する（メモリ上にしか残らない変更を増やさない）。
+        """
+        if self.flush_failures < MAX_FLUSH_FAILURES:
+            return
+        try:
+            await self.flush()
+        except Exception as e:
+            raise StateUnavailable(f"Racing data cannot be saved: {e}") from e
+
+    async def _commit(self):
+        """
+        変更をリビジョン付きで書き込む。他のプロセスが先に書き込んでいた場合は
+        その変更を取り込んでから再試行する。
+        """
+        for _ in range(MAX_CONFLICT_RETRIES):
+            stored = await _store_data(self.data, self._rows, self.rev)
+            if stored is not None:
+                self._rows, size_delta = stored
+                self.size += size_delta
+                self.rev += 1
+                self._report_size()
+                return
+            await self._merge_remote()
+        raise RuntimeError("Could not commit racing data (too many conflicts)")
+
+    async def _merge_remote(self):
+        """
+        他のプロセスが書き込んだ行を取り込む。
+        こちらで未保存の変更がある行はこちらの値を優先する（行単位でのマージ）。
+        """
+        remote, rev_row = await _select_state()
+        rev_row = rev_row or {}
+        dirty = self.data.dirty_rows
+        for key, value in remote.items():
+            encoded = json.dumps(value, ensure_ascii=False)
+            previous = self._rows.get(key)
+            if previous == encoded:
+                continue
+            if key not in dirty:
+                self.data.apply_row(key, value)
+            self.size += len(encoded.encode()) - (len(previous.encode()) if previous is not None else 0)
+            self._rows[key] = encoded
+        for key in [k for k in self._rows if k not in remote]:
+            if key not in dirty:
+                self.data.apply_row(key, None)
+            self.size -= len(self._rows.pop(key).encode())
+        self.rev = rev_row.get("rev", 0)
+        self._report_size()
+        print(f"Merged remote racing data changes (rev {self.rev})")
+
+    async def discard(self, delete):
+        """
+        delete() で保存済みのデータを削除してから、キャッシュを破棄する。
+        削除中に遅延保存が行を書き戻したり、削除途中の行が読み込まれたりしないよう、
+        保存・読み込みのロックを持ったまま行う（削除中の読み取りには削除前のメモリ上の状態を返す）。
+        """
+        async with self._load_lock, self._flush_lock:
+            await delete()
+            self.reset()
+
+    def reset(self):
+        """キャッシュを破棄する（次回アクセス時に再読み込み）"""
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+        self._flush_task = None
+        self._dirty = False
+        self._rows = {}
+        self.rev = 0
+        self.size = 0
+        self.data = None
+
+
+class StateUnavailable(RuntimeError):
+    """保存の失敗が続いていて、状態の変更を受け付けられない"""
+
+
+STATE = StateCache()
+
+# 状態を変更する処理をプロセス内で直列化するロック
+STATE_LOCK = asyncio.Lock()
+# レース結果の告知を直列化するロック（告知は STATE_LOCK の外で行う）
+PUBLISH_LOCK = asyncio.Lock()
+
+def serialized(func):
+    """
+    コマンドを STATE_LOCK の下で実行するデコレータ。
+    読み込みから保存までの間に他のコマンドの変更が割り込まないようにする。
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        async with STATE_LOCK:
+            await STATE.ensure_writable()
+            return await func(*args, **kwargs)
+    return wrapper
+
+# ライタータスクが変更をまとめて書き込む間隔（秒）
+BATCH_WINDOW_SECONDS = 0.25
+
+class MutationQueue:
+    """
+    状態を変更する操作を1つのライタータスクに集約するキュー。
+    操作は投入順に適用し、バッチ間隔ごとに1回だけ書き込む。
+    各操作の結果は、そのバッチの書き込みが完了してから呼び出し元に返す
+    （書き込みに失敗した場合も、遅延保存で再試行するため結果は返す）。
+    ただし保存の失敗が MAX_FLUSH_FAILURES 回続いている間は、操作を適用せずに
+    StateUnavailable で失敗させる。
+    """
+
+    def __init__(self):
+        self._queue = asyncio.Queue()
+        self._task = None
+
+    async def submit(self, op):
+        """op(data) をライターで実行し、書き込み確定後にその戻り値を返す"""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((op, future))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return await future
+
+    async def _next_batch(self):
+        batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + BATCH_WINDOW_SECONDS
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                # 期限後でも、すでに届いている操作は同じバッチに含める
+                while not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                return batch
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            results = []
+            async with STATE_LOCK:
+                try:
+                    data = await load_data()
+                    await STATE.ensure_writable()
+                except Exception as e:
+                    # 状態を読み込めない・保存できない場合は、このバッチの操作はすべて失敗として返す
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for op, future in batch:
+                    try:
+                        results.append((future, op(data), None))
+                    except Exception as e:
+                        results.append((future, None, e))
+
+            try:
+                await STATE.flush()
+            except Exception as e:
+                # メモリ上には反映済みで、書き込みは遅延保存で再試行する。
+                # 失敗として返すと利用者が再実行して二重に反映されるため、結果はそのまま返す
+                print(f"Failed to flush racing data, will retry: {e}")
+                STATE.mark_dirty()
+
+            for future, result, error in results:
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+
+MUTATIONS = MutationQueue()
+
+async def mutate(op):
+    """状態を変更する操作をライタータスクに投入し、確定後の結果を返す"""
+    return await MUTATIONS.submit(op)
+
+async def load_data():
+    return await STATE.get()
 
 
 async def save_data(data):
-    # Supabaseにデータを保存（upsertで更新）
-    supabase.table("kv_store").upsert({
-        "key": DATA_KEY,
-        "value": data
-    }).execute()
+    STATE.data = data
+    STATE.mark_dirty()
+
+# --------------- レース結果アーカイブ ---------------
+
+# レース結果は状態とは別のキー空間に追記していく（起動時の一括読み込みの対象外）
+RESULTS_PREFIX = "racing_results:"
+# 馬ごとの結果一覧の1ページあたり件数
+RESULTS_PAGE_SIZE = 5
+# メモリに保持する日別結果の最大件数
+RESULTS_CACHE_SIZE = 64
+
+def _date_code(year, month, day):
+    return f"{year:04d}{month:02d}{day:02d}"
+
+class ResultArchive:
+    """
+    追記専用のレース結果ログ。
+    ・日付ごとの行 racing_results:day:<YYYYMMDD> にその日のレース一覧を保存
+    ・馬ごとの参照行 racing_results:horse:<馬ID>:<YYYYMMDD>:<番号> で馬から逆引き
+    日付・馬IDのどちらも主キーで直接引けるため、結果が増えても検索コストは変わらない。
+    """
+
+    def __init__(self):
+        self._days = OrderedDict()
+
+    @staticmethod
+    def _day_key(year, month, day):
+        return f"{RESULTS_PREFIX}day:{_date_code(year, month, day)}"
+
+    @staticmethod
+    def _horse_prefix(horse_id):
+        return f"{RESULTS_PREFIX}horse:{horse_id}:"
+
+    def _remember(self, key, races):
+        self._days[key] = races
+        self._days.move_to_end(key)
+        while len(self._days) > RESULTS_CACHE_SIZE:
+            self._days.popitem(last=False)
+
+    async def _load_day(self, key):
+        if key in self._days:
+            self._days.move_to_end(key)
+            return self._days[key]
+        races = await run_db(lambda: STORAGE.get(key)) or []
+        self._remember(key, races)
+        return races
+
+    async def races_on(self, year, month, day):
+        """指定日のレース結果一覧を開催順で返す"""
+        return list(await self._load_day(self._day_key(year, month, day)))
+
+    async def append(self, race):
+        """レース結果を追記する（race には year/month/day/results を含める）"""
+        key = self._day_key(race["year"], race["month"], race["day"])
+        races = list(await self._load_day(key))
+        if any(r["name"] == race["name"] for r in races):
+            # 再開時に同じレースを二重に記録しない
+            return
+        races.append(race)
+        await run_db(lambda: STORAGE.upsert({key: races}))
+        self._remember(key, races)
+
+        number = len(races) - 1
+        code = _date_code(race["year"], race["month"], race["day"])
+        refs = {
+            f"{self._horse_prefix(r['horse_id'])}{code}:{number:02d}": {"day": key, "index": number}
+            for r in race["results"] if r["owner"] != BOT_OWNER_ID
+        }
+        await _upsert_rows(refs)
+
+    async def races_of_horse(self, horse_id, page=1):
+        """馬が出走したレース結果を新しい順に1ページ分返す"""
+        start = (page - 1) * RESULTS_PAGE_SIZE
+        refs = await run_db(lambda: STORAGE.scan(self._horse_prefix(horse_id), start, RESULTS_PAGE_SIZE, desc=True))
+        races = []
+        for _, ref in refs:
+            day_races = await self._load_day(ref["day"])
+            if ref["index"] < len(day_races):
+                races.append(day_races[ref["index"]])
+        return races
+
+    def clear_cache(self):
+        self._days.clear()
+
+
+RESULTS = ResultArchive()
+
+# --------------- 出走履歴ストア ---------------
+
+# 馬ごとの出走履歴も状態とは別のキー空間に保存する
+HISTORY_PREFIX = "racing_history:"
+# 1頭あたりに保持する履歴の上限（自動引退のレース数と同じ）
+HISTORY_CAP = 50
+# 履歴1件の列（保存時は dict ではなくこの順のリストに詰める）
+HISTORY_FIELDS = ("year", "month", "day", "race", "pos", "prize", "score")
+HISTORY_CACHE_SIZE = 128
 
+def race_count(horse):
+    """出走回数（履歴を状態に持っていた頃のデータにも対応）"""
+    return horse.get("race_count", len(horse.get("history", [])))
 
-def calculate_odds(horse):
+class HistoryStore:
     """
-    勝利数をもとに固定オッズ計算
+    馬ごとの出走履歴。1レース1行 racing_history:<馬ID>:<出走番号> で追記し、
+    !racehistory で必要になったときだけ読み込む。
+    状態側の馬データには出走回数などの集計値だけを持たせる。
     """
-    base = 6.0
-    wins = horse.get("wins", 0)
-    odds = base / (wins + 1)
-    return round(max(1.2, odds), 1)
+
+    def __init__(self):
+        self._cache = OrderedDict()
+        self._pending_deletes = set()
+        self._delete_task = None
+
+    @staticmethod
+    def _prefix(horse_id):
+        return f"{HISTORY_PREFIX}{horse_id}:"
+
+    def _row_key(self, horse_id, number):
+        return f"{self._prefix(horse_id)}{number:03d}"
+
+    @staticmethod
+    def encode(entry):
+        return [entry.get(field) for field in HISTORY_FIELDS]
+
+    @staticmethod
+    def decode(row):
+        return dict(zip(HISTORY_FIELDS, row))
+
+    async def load(self, horse_id):
+        """馬の出走履歴を古い順に返す"""
+        if horse_id in self._cache:
+            self._cache.move_to_end(horse_id)
+            return self._cache[horse_id]
+        rows = await run_db(lambda: STORAGE.scan(self._prefix(horse_id)))
+        history = [self.decode(value) for _, value in rows]
+        self._cache[horse_id] = history
+        while len(self._cache) > HISTORY_CACHE_SIZE:
+            self._cache.popitem(last=False)
+        return history
+
+    async def append(self, entries):
+        """
+        entries: [(馬ID, 出走番号, 履歴dict), ...] を追記する。
+        上限を超えた古い行は削除する。
+        """
+        rows = {}
+        expired = []
+        for horse_id, number, entry in entries:
+            rows[self._row_key(horse_id, number)] = self.encode(entry)
+            if number > HISTORY_CAP:
+                expired.append(self._row_key(horse_id, number - HISTORY_CAP))
+            if horse_id in self._cache:
+                self._cache[horse_id] = (self._cache[horse_id] + [entry])[-HISTORY_CAP:]
+        await _upsert_rows(rows)
+        if expired:
+            await _delete_rows(expired)
+
+    def discard(self, horse_id):
+        """引退した馬の履歴を削除する（同期処理から呼べるよう、削除は裏で行う）"""
+        self._cache.pop(horse_id, None)
+        self._pending_deletes.add(horse_id)
+        if self._delete_task is None or self._delete_task.done():
+            self._delete_task = asyncio.create_task(self._drain_deletes())
+
+    async def _drain_deletes(self):
+        while self._pending_deletes:
+            horse_id = self._pending_deletes.pop()
+            try:
+                await run_db(lambda: STORAGE.delete_prefix(self._prefix(horse_id)))
+            except Exception as e:
+                print(f"Failed to delete history of {horse_id}: {e}")
+
+    def clear_cache(self):
+        self._cache.clear()
+
+
+HISTORY = HistoryStore()
+
+async def migrate_legacy_history():
+    """馬データに埋め込まれていた history を履歴ストアへ移し、集計値に置き換える"""
+    data = await load_data()
+    legacy = {hid: list(h["history"]) for hid, h in data["horses"].items() if "history" in h}
+    entries = [
+        (hid, number, dict(entry))
+        for hid, history in legacy.items()
+        for number, entry in enumerate(history[-HISTORY_CAP:], start=max(1, len(history) - HISTORY_CAP + 1))
+    ]
+    if entries:
+        await HISTORY.append(entries)
+
+    def op(data):
+        for hid, history in legacy.items():
+            horse = data["horses"].get(hid)
+            if horse is None or "history" not in horse:
+                continue
+            horse["race_count"] = len(history)
+            horse["prize_total"] = sum(entry.get("prize", 0) for entry in history)
+            del horse["history"]
+        return len(legacy)
+
+    return await mutate(op) if legacy else 0
+
+async def migrate_legacy_races():
+    """旧形式で状態に含まれていた data["races"] をアーカイブへ移す"""
+    data = await load_data()
+    legacy = list(data.get("races") or [])
+    for race in legacy:
+        await RESULTS.append(race)
+    if "races" in data:
+        await mutate(lambda d: d.pop("races", None))
+    return len(legacy)
 
 
 def default_schedule():
@@ -215,18 +1583,21 @@ def new_bot_horse_id(existing_ids):
         base = "B" + str(random.randint(10000, 99999))
     return base
 
+# Bot馬のステータス範囲（両端を含む。オッズ計算の補充馬も同じ範囲から引く）
+BOT_STAT_RANGES = {
+    "speed": (80, 100),
+    "stamina": (80, 100),
+    "temper": (70, 100),
+    "growth": (70, 100),
+    "turf_apt": (80, 95),
+    "dirt_apt": (80, 95),
+}
+
 def generate_bot_horse(existing_ids):
     """Bot馬を生成する"""
     horse_id = new_bot_horse_id(existing_ids)
     
-    stats = {
-        "speed": random.randint(80, 100),
-        "stamina": random.randint(80, 100),
-        "temper": random.randint(70, 100),
-        "growth": random.randint(70, 100),
-        "turf_apt": random.randint(80, 95), 
-        "dirt_apt": random.randint(80, 95), 
-    }
+    stats = {key: random.randint(low, high) for key, (low, high) in BOT_STAT_RANGES.items()}
     
     bot_names = [
         "キョウカイノホシ", "アイビスフライト", "シルバーファントム", 
@@ -242,7 +1613,6 @@ def generate_bot_horse(existing_ids):
         "age": random.randint(3, 5),
         "fatigue": 0,
         "wins": 0,
-        "history": [],
         "favorite": False,
         "rest_used_day": -1 
     }
@@ -255,37 +1625,45 @@ def get_lower_race_entries(data, current_day_str):
     ・疲労1以下
     ・Bot馬は除外
     """
-    entries = []
+    g1_entries = entry_book(data).members(current_day_str)
 
-    g1_entries = set(
-        data.get("pending_entries", {}).get(current_day_str, [])
-    )
+    # 疲労1以下のプレイヤー馬（索引にはBot馬は含まれない）からGⅠ登録馬を除外
+    candidates = horse_index(data).with_fatigue_at_most(1) - g1_entries
 
-    for horse_id, horse in data["horses"].items():
-        # Bot馬を除外
-        if horse.get("owner") == BOT_OWNER_ID:
-            continue
+    # 集合には順序がないため、結果を安定させるようID順で返す
+    return sorted(candidates)
 
-        # GⅠ登録馬を除外
-        if horse_id in g1_entries:
-            continue
+# --------------- レーススコア計算 ---------------
 
-        # 疲労条件
-        if horse.get("fatigue", 0) > 1:
-            continue
+# レース用の乱数生成器（シミュレーションではシードを固定した生成器を渡す）
+RACE_RNG = np.random.default_rng()
 
-        entries.append(horse_id)
+# field_stats() が返す配列の列
+FIELD_COLUMNS = ("speed", "stamina", "temper", "growth", "turf_apt", "dirt_apt", "fatigue")
 
-    return entries
+def field_stats(horses):
+    """出走馬のステータスを (頭数, len(FIELD_COLUMNS)) の配列にまとめる"""
+    return np.array([
+        [
+            h["stats"]["speed"],
+            h["stats"]["stamina"],
+            h["stats"]["temper"],
+            h["stats"]["growth"],
+            h["stats"].get("turf_apt", 70),
+            h["stats"].get("dirt_apt", 70),
+            h.get("fatigue", 0),
+        ]
+        for h in horses
+    ], dtype=np.float64).reshape(-1, len(FIELD_COLUMNS))
 
-def calc_race_score(horse, distance, track):
-    s = horse["stats"]
-    speed = s["speed"]
-    stamina = s["stamina"]
-    temper = s["temper"] # TEMPER (気性)
-    growth = s["growth"] # GROWTH (成長力/バフ)
-    turf_apt = s.get("turf_apt", 70) 
-    dirt_apt = s.get("dirt_apt", 70) 
+def score_field(stats, distance, track, rng=None):
+    """
+    出走馬全頭のスコアをまとめて計算し、(スコア配列, 着順のインデックス配列) を返す。
+    計算式と乱数の分布は1頭ずつ計算していた頃の calc_race_score と同じ。
+    stats は (頭数, 列) のほか (試行回数, 頭数, 列) も受け付け、最後の軸が各馬の列になる。
+    """
+    rng = RACE_RNG if rng is None else rng
+    speed, stamina, temper, growth, turf_apt, dirt_apt, fatigue = np.moveaxis(stats, -1, 0)
 
     # 距離適性
     if distance <= 1400:
@@ -294,36 +1672,255 @@ def calc_race_score(horse, distance, track):
         base = speed * 0.5 + stamina * 0.5
     else:
         base = speed * 0.3 + stamina * 0.7
-    
-    # 馬場適性
-    if track == "ダート":
-        apt_factor = dirt_apt / 100 
-    else:
-        apt_factor = turf_apt / 100
 
-    # 根幹能力以外の補正 (GRW/TEMによる基本スコア補正)
+    # 馬場適性と根幹能力以外の補正（ダートはTEM、芝はGRW）
     if track == "ダート":
-        # TEMのダート補正を維持
-        condition_factor = 0.95 + (temper / 100) * 0.1 
+        apt_factor = dirt_apt / 100
+        condition_factor = 0.95 + (temper / 100) * 0.1
     else:
-        # 芝ではGRWの補正を維持
+        apt_factor = turf_apt / 100
         condition_factor = 1.0 + (growth / 100) * 0.15
 
     # 疲労とコンディション計算
-    fatigue = horse.get("fatigue", 0)
-    cond = max(0.75, 1.0 - (fatigue * 0.02))
-    
-    # --- ★ TEMPER (気性) によるランダム幅の調整 ★ ---
-    # TEMが高いほど下限が上がり、下振れを防ぐ。上限は固定で大穴の可能性を維持。
-    tem_stab_factor = (temper / 100) * 0.15 
-    lower_bound = 0.85 + tem_stab_factor
-    
-    # 上限は1.15のまま維持
-    rand = random.uniform(lower_bound, 1.15)
-    # --- ★ 調整ここまで ★ ---
+    cond = np.maximum(0.75, 1.0 - (fatigue * 0.02))
+
+    # TEMが高いほど下限が上がり、下振れを防ぐ。上限は1.15で固定。
+    lower_bound = 0.85 + (temper / 100) * 0.15
+    rand = rng.uniform(lower_bound, 1.15)
+
+    scores = base * apt_factor * condition_factor * rand * cond
+    # 同点の場合は馬番順（安定ソート）
+    order = np.argsort(-scores, axis=-1, kind="stable")
+    return scores, order
+
+def calc_race_score(horse, distance, track, rng=None):
+    """1頭分のスコア"""
+    scores, _ = score_field(field_stats([horse]), distance, track, rng)
+    return float(scores[0])
+
+# --------------- オッズ計算 ---------------
+
+# 1レースあたりのシミュレーション回数
+ODDS_SIMULATIONS = 4000
+# 控除率（公正オッズからこの割合を差し引く）
+ODDS_MARGIN = 0.2
+ODDS_MIN = 1.1
+ODDS_MAX = 999.9
+ODDS_CACHE_SIZE = 32
+
+class OddsEngine:
+    """
+    出走馬全体でレースを繰り返しシミュレーションし、勝率からオッズを求める。
+    スコアの計算は本番と同じ score_field を使い、GⅠで頭数が足りない分は
+    Bot馬と同じ範囲のステータスを試行ごとに引いて補充する。
+    結果は (日, 出走馬の構成) ごとにキャッシュし、エントリーが変わったら破棄する。
+    """
+
+    def __init__(self, simulations=ODDS_SIMULATIONS, margin=ODDS_MARGIN, rng=None):
+        self.simulations = simulations
+        self.margin = margin
+        self._rng = np.random.default_rng() if rng is None else rng
+        self._cache = OrderedDict()
+        self._refresh_tasks = {}
+
+    @staticmethod
+    def _field_key(data, day_key):
+        """出走馬の構成（ID・ステータス・疲労）。どれかが変わればキャッシュは使わない"""
+        key = []
+        for hid in entry_book(data).entries(day_key):
+            horse = data["horses"].get(hid)
+            if horse:
+                key.append((hid, tuple(horse["stats"].get(c, 70) for c in FIELD_COLUMNS[:-1]), horse.get("fatigue", 0)))
+        return tuple(key)
+
+    def _simulate(self, race_info, field_key):
+        """各馬のオッズ {馬ID: オッズ} を計算する（I/O なし・スレッドから呼べる）"""
+        horse_ids = [hid for hid, _, _ in field_key]
+        players = np.array([list(stats) + [fatigue] for _, stats, fatigue in field_key], dtype=np.float64)
+        stats = np.broadcast_to(players, (self.simulations,) + players.shape)
+
+        bots = max(0, MIN_G1_FIELD - len(horse_ids))
+        if bots:
+            bot_stats = np.zeros((self.simulations, bots, len(FIELD_COLUMNS)))
+            for col, key in enumerate(FIELD_COLUMNS[:-1]):
+                low, high = BOT_STAT_RANGES[key]
+                bot_stats[:, :, col] = self._rng.integers(low, high + 1, size=(self.simulations, bots))
+            stats = np.concatenate([stats, bot_stats], axis=1)
+
+        scores, _ = score_field(stats, race_info["distance"], race_info["track"], self._rng)
+        wins = np.bincount(scores.argmax(axis=1), minlength=stats.shape[1])[:len(horse_ids)]
+
+        odds = {}
+        for hid, win_count in zip(horse_ids, wins):
+            if win_count == 0:
+                odds[hid] = ODDS_MAX
+                continue
+            fair = self.simulations / win_count
+            odds[hid] = round(min(ODDS_MAX, max(ODDS_MIN, fair * (1 - self.margin))), 1)
+        return odds
+
+    def _cached(self, data, day_key):
+        """(race_info, キャッシュキー, キャッシュ済みオッズ or None)"""
+        race_info = data["schedule"].get(day_key)
+        cache_key = (day_key, self._field_key(data, day_key))
+        odds = self._cache.get(cache_key)
+        if odds is not None:
+            self._cache.move_to_end(cache_key)
+        return race_info, cache_key, odds
+
+    async def fetch(self, data, day_key):
+        """指定日の出走馬のオッズ。キャッシュがなければスレッドで計算する"""
+        race_info, cache_key, odds = self._cached(data, day_key)
+        if odds is None:
+            odds = await asyncio.to_thread(self._simulate, race_info, cache_key[1]) if race_info and cache_key[1] else {}
+            self._store(cache_key, odds)
+        return odds
+
+    def _store(self, cache_key, odds):
+        self._cache[cache_key] = odds
+        while len(self._cache) > ODDS_CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    def invalidate(self, day_key):
+        """エントリー変更時に呼ぶ。その日のキャッシュを捨て、裏で計算し直す"""
+        for cache_key in [k for k in self._cache if k[0] == day_key]:
+            del self._cache[cache_key]
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        task = self._refresh_tasks.get(day_key)
+        if task is None or task.done():
+            self._refresh_tasks[day_key] = asyncio.create_task(self._refresh(day_key))
+
+    async def _refresh(self, day_key):
+        # 同じバッチ内の変更がすべて反映されてから出走馬を読み取る
+        await asyncio.sleep(0)
+        try:
+            await self.fetch(await load_data(), day_key)
+        except Exception as e:
+            print(f"Failed to refresh odds for day {day_key}: {e}")
+
+    def clear_cache(self):
+        self._cache.clear()
+
+
+ODDS = OddsEngine()
+
+# --------------- 馬券（パリミュチュエル方式） ---------------
+
+# 券種: 単勝（1着） / 複勝（3着以内） / 馬連（1・2着の組み合わせ、順不同）
+BET_TYPES = {"win": "単勝", "place": "複勝", "quinella": "馬連"}
+# 控除率（予想オッズと同じ値を使う）
+BET_TAKEOUT = ODDS_MARGIN
+# 複勝の対象着順
+PLACE_POSITIONS = 3
+
+def quinella_key(horse_a, horse_b):
+    return "-".join(sorted((horse_a, horse_b)))
+
+def bet_pool(data, day_key):
+    """
+    指定日の馬券プール。
+      totals  {券種: 総票数}
+      pools   {券種: {買い目: 票数}}           … オッズを O(1) で引くための集計
+      tickets {券種: {買い目: {ユーザーID: 金額}}} … 同じ買い目の追加購入は合算する
+    1ベット1件ではなく買い目ごとに集約して持つため、利用者が増えても大きくならない。
+    """
+    bets = data.setdefault("bets", {})
+    pool = bets.get(day_key)
+    if pool is None or "pools" not in pool:
+        bets[day_key] = as_pool(pool)
+    return bets[day_key]
+
+def as_pool(raw):
+    """保存されている値をプール形式で返す（状態は変更しない）"""
+    if raw and "pools" in raw:
+        return raw
+    pool = {
+        "totals": {t: 0 for t in BET_TYPES},
+        "pools": {t: {} for t in BET_TYPES},
+        "tickets": {t: {} for t in BET_TYPES},
+    }
+    # 旧形式（{ユーザーID: {"horse_id", "amount", "odds"}}）は単勝として引き継ぐ
+    for uid, b in (raw or {}).items():
+        add_ticket(pool, uid, "win", b["horse_id"], b["amount"])
+    return pool
+
+def add_ticket(pool, uid, bet_type, selection, amount):
+    pool["totals"][bet_type] += amount
+    stakes = pool["pools"][bet_type]
+    stakes[selection] = stakes.get(selection, 0) + amount
+    holders = pool["tickets"][bet_type].setdefault(selection, {})
+    holders[uid] = holders.get(uid, 0) + amount
+
+def _floor_dividend(rate):
+    # 10円単位（0.1倍単位）で切り捨て、元返し（1.0倍）を下回らない
+    return max(1.0, int(rate * 10) / 10)
+
+def pool_odds(pool, bet_type, selection):
+    """現時点の払い戻し倍率（票がなければ None）"""
+    stake = pool["pools"][bet_type].get(selection, 0) if pool else 0
+    if not stake:
+        return None
+    net = pool["totals"][bet_type] * (1 - BET_TAKEOUT)
+    if bet_type == "place":
+        # 他の複勝対象馬にも票が入る前提での目安（利益を対象頭数で等分）
+        return _floor_dividend(1 + (net - stake) / PLACE_POSITIONS / stake)
+    return _floor_dividend(net / stake)
+
+def settle_bets(pool, results):
+    """
+    着順から払い戻し額 {ユーザーID: 金額} を計算する。
+    券種ごとに的中した買い目の票だけを走査する。
+    的中した票がない券種は払い戻しなし（協会生産馬が上位を占めた場合など。従来の単勝と同じく没収）。
+    """
+    payouts = {}
+    finish = [r["horse_id"] for r in results]
+    hits_by_type = {
+        "win": finish[:1],
+        "place": finish[:PLACE_POSITIONS],
+        "quinella": [quinella_key(finish[0], finish[1])] if len(finish) >= 2 else [],
+    }
+
+    for bet_type in BET_TYPES:
+        stakes = pool["pools"][bet_type]
+        total = pool["totals"][bet_type]
+        if not total:
+            continue
+        net = total * (1 - BET_TAKEOUT)
+        hits = [sel for sel in hits_by_type[bet_type] if stakes.get(sel)]
+
+        if not hits:
+            continue
+        if bet_type == "place":
+            share = (net - sum(stakes[sel] for sel in hits)) / len(hits)
+            rates = {sel: _floor_dividend(1 + share / stakes[sel]) for sel in hits}
+        else:
+            rates = {sel: _floor_dividend(net / stakes[sel]) for sel in hits}
+
+        for sel, rate in rates.items():
+            for uid, amount in pool["tickets"][bet_type][sel].items():
+                payouts[uid] = payouts.get(uid, 0) + int(amount * rate)
+    return payouts
 
-    score = base * apt_factor * condition_factor * rand * cond
-    return score
+def withdraw_horse(pool, horse_id):
+    """
+    出走を取り消した馬の買い目（単勝・複勝はその馬、馬連はその馬を含む組）をプールから外し、
+    返還額 {ユーザーID: 金額} を返す。外した票はオッズ・払い戻しの計算にも含めない。
+    """
+    refunds = {}
+    for bet_type in BET_TYPES:
+        tickets = pool["tickets"][bet_type]
+        if bet_type == "quinella":
+            selections = [sel for sel in tickets if horse_id in sel.split("-")]
+        else:
+            selections = [horse_id] if horse_id in tickets else []
+        for sel in selections:
+            pool["totals"][bet_type] -= pool["pools"][bet_type].pop(sel, 0)
+            for uid, amount in tickets.pop(sel).items():
+                refunds[uid] = refunds.get(uid, 0) + amount
+    return refunds
 
 def prize_pool_for_g1(race_name):
     """GⅠレース名に基づき、賞金プールを決定する"""
@@ -428,7 +2025,351 @@ async def announce_race_results(data, race_info, results, day, month, year, chan
         
         msg_lines.append(line)
         
-    await channel.send("\n".join(msg_lines))
+    await send_lines(channel, msg_lines)
+
+class EntryBook:
+    """
+    pending_entries（{日: [馬ID, ...]}）の索引付きビュー。
+    ・日ごとの出走馬集合（登録済みかどうかを O(1) で判定）
+    ・日ごと・オーナーごとの登録頭数
+    ・馬ID → 登録日の逆引き
+    ・日ごとの版（エントリーの増減や出走馬の値の変更で上がる。描画キャッシュのキーに使う）
+    保存用のリストはそのまま保持するため、登録順（馬番の元）は変わらない。
+    エントリーの追加・削除は必ずこのクラスを経由すること。
+    """
+
+    def __init__(self, data):
+        self._data = data
+        self._members = {}
+        self._owner_counts = {}
+        self._days_by_horse = {}
+        # 登録時点のオーナー（引退で馬が消えた後でも頭数を戻せるように保持）
+        self._horse_owner = {}
+        # 版は全インスタンスで通し番号にし、状態を読み直しても古い版と重ならないようにする
+        self._base_version = next(_ENTRY_VERSIONS)
+        self._versions = {}
+        for day_key, hids in data.get("pending_entries", {}).items():
+            for hid in hids:
+                self._index(day_key, hid)
+
+    def _owner_of(self, horse_id):
+        horse = self._data["horses"].get(horse_id)
+        return horse["owner"] if horse else None
+
+    def _index(self, day_key, horse_id):
+        self._members.setdefault(day_key, set()).add(horse_id)
+        owner = self._horse_owner.setdefault(horse_id, self._owner_of(horse_id))
+        counts = self._owner_counts.setdefault(day_key, {})
+        counts[owner] = counts.get(owner, 0) + 1
+        self._days_by_horse.setdefault(horse_id, set()).add(day_key)
+
+    def _unindex(self, day_key, horse_id):
+        self._members[day_key].discard(horse_id)
+        if not self._members[day_key]:
+            del self._members[day_key]
+        owner = self._horse_owner[horse_id]
+        counts = self._owner_counts[day_key]
+        counts[owner] -= 1
+        if not counts[owner]:
+            del counts[owner]
+        if not counts:
+            del self._owner_counts[day_key]
+        days = self._days_by_horse[horse_id]
+        days.discard(day_key)
+        if not days:
+            del self._days_by_horse[horse_id]
+            del self._horse_owner[horse_id]
+
+    def entries(self, day_key):
+        """指定日の出走馬IDを登録順で返す"""
+        return self._data.get("pending_entries", {}).get(day_key, [])
+
+    def count(self, day_key):
+        return len(self._members.get(day_key, ()))
+
+    def contains(self, day_key, horse_id):
+        return horse_id in self._members.get(day_key, ())
+
+    def members(self, day_key):
+        return self._members.get(day_key, set())
+
+    def owner_count(self, day_key, owner_id):
+        return self._owner_counts.get(day_key, {}).get(owner_id, 0)
+
+    def days_of(self, horse_id):
+        return self._days_by_horse.get(horse_id, set())
+
+    def version(self, day_key):
+        return self._versions.get(day_key, self._base_version)
+
+    def _bump(self, day_key):
+        self._versions[day_key] = next(_ENTRY_VERSIONS)
+
+    def touch(self, horse_id):
+        """出走登録中の馬の値（疲労・勝利数・ステータス）が変わったときに呼ぶ"""
+        for day_key in self.days_of(horse_id):
+            self._bump(day_key)
+
+    def add(self, day_key, horse_id):
+        """登録に成功したら True、既に登録済みなら False を返す"""
+        if self.contains(day_key, horse_id):
+            return False
+        pending = self._data.setdefault("pending_entries", {})
+        if day_key not in pending:
+            pending[day_key] = []
+        pending[day_key].append(horse_id)
+        self._index(day_key, horse_id)
+        self._bump(day_key)
+        ODDS.invalidate(day_key)
+        return True
+
+    def remove(self, day_key, horse_id):
+        """登録を取り消せたら True を返す"""
+        return bool(self.remove_horses([horse_id], day_keys=[day_key]))
+
+    def remove_horses(self, horse_ids, day_keys=None):
+        """
+        複数の馬をまとめて登録解除し、解除した件数を返す。
+        逆引きで該当日だけを対象にし、各日のリストは1回だけ作り直す。
+        """
+        targets = {}
+        for hid in horse_ids:
+            for day_key in self.days_of(hid):
+                if day_keys is None or day_key in day_keys:
+                    targets.setdefault(day_key, set()).add(hid)
+
+        pending = self._data.get("pending_entries", {})
+        removed = 0
+        for day_key, hids in targets.items():
+            remaining = [hid for hid in pending[day_key] if hid not in hids]
+            if remaining:
+                pending[day_key] = remaining
+            else:
+                # エントリーリストが空になったらキー自体を削除
+                del pending[day_key]
+            for hid in hids:
+                self._unindex(day_key, hid)
+            removed += len(hids)
+            self._bump(day_key)
+            ODDS.invalidate(day_key)
+        return removed
+
+    def clear_day(self, day_key):
+        """指定日のエントリーをすべて削除する"""
+        self.remove_horses(list(self.entries(day_key)), day_keys=[day_key])
+        self._data.get("pending_entries", {}).pop(day_key, None)
+
+
+_ENTRY_VERSIONS = itertools.count(1)
+
+def entry_book(data):
+    """状態に対応する EntryBook を返す（RacingState では索引を使い回す）"""
+    indexes = getattr(data, "indexes", None)
+    if indexes is None:
+        return EntryBook(data)
+    if "entries" not in indexes:
+        indexes["entries"] = EntryBook(data)
+    return indexes["entries"]
+
+# 自動引退の条件
+RETIRE_RACE_COUNT = 50
+RETIRE_AGE = 6
+
+class HorseIndex:
+    """
+    data["horses"] の二次索引（保存はしない）。
+    ・プレイヤー馬（Bot馬以外）の集合
+    ・疲労度ごとのプレイヤー馬の集合
+    ・休養済み（rest_used_day が設定済み）の馬の集合
+    ・自動引退の条件を満たした馬の集合
+    馬を追加・変更・削除したら update() / remove() を呼ぶこと。
+    オーナー → 馬の対応は owners[uid]["horses"] が保存済みの索引を兼ねる。
+    """
+
+    def __init__(self, data):
+        self._players = set()
+        self._by_fatigue = {}
+        self._rested = set()
+        self._retire_due = set()
+        self._fatigue_of = {}
+        self._entries = None
+        for horse in data["horses"].values():
+            self.update(horse)
+        self._entries = entry_book(data)
+
+    def update(self, horse):
+        """馬の現在の値に合わせて索引を更新する"""
+        horse_id = horse["id"]
+        if horse.get("owner") == BOT_OWNER_ID:
+            self.remove(horse_id)
+            return
+        self._players.add(horse_id)
+
+        fatigue = horse.get("fatigue", 0)
+        old = self._fatigue_of.get(horse_id)
+        if old != fatigue:
+            if old is not None:
+                self._by_fatigue[old].discard(horse_id)
+            self._by_fatigue.setdefault(fatigue, set()).add(horse_id)
+            self._fatigue_of[horse_id] = fatigue
+
+        if horse.get("rest_used_day", -1) != -1:
+            self._rested.add(horse_id)
+        else:
+            self._rested.discard(horse_id)
+
+        if race_count(horse) >= RETIRE_RACE_COUNT or horse.get("age", 0) >= RETIRE_AGE:
+            self._retire_due.add(horse_id)
+        else:
+            self._retire_due.discard(horse_id)
+
+        # 出走登録中の馬なら出馬表・オッズ表の描画キャッシュを使わせない
+        if self._entries is not None:
+            self._entries.touch(horse_id)
+
+    def remove(self, horse_id):
+        self._players.discard(horse_id)
+        fatigue = self._fatigue_of.pop(horse_id, None)
+        if fatigue is not None:
+            self._by_fatigue[fatigue].discard(horse_id)
+        self._rested.discard(horse_id)
+        self._retire_due.discard(horse_id)
+
+    def player_ids(self):
+        return self._players
+
+    def with_fatigue_at_most(self, max_fatigue):
+        """疲労が max_fatigue 以下のプレイヤー馬IDを返す"""
+        result = set()
+        for fatigue, ids in self._by_fatigue.items():
+            if fatigue <= max_fatigue:
+                result |= ids
+        return result
+
+    def rested_ids(self):
+        return self._rested
+
+    def retire_due_ids(self):
+        return self._retire_due
+
+
+def horse_index(data):
+    """状態に対応する HorseIndex を返す（RacingState では索引を使い回す）"""
+    indexes = getattr(data, "indexes", None)
+    if indexes is None:
+        return HorseIndex(data)
+    if "horses" not in indexes:
+        indexes["horses"] = HorseIndex(data)
+    return indexes["horses"]
+
+# --------------- ランキング ---------------
+
+RANK_CATEGORIES = ("prize", "wins")
+RANK_PAGE_SIZE = 10
+
+def season_id(data):
+    """現在のシーズン（30日 = 1か月）の識別子"""
+    return f"{data['season']['year']}-{data['season']['month']:02d}"
+
+class Board:
+    """
+    スコア降順（同点はID順）に並べたランキング。
+    更新は二分探索で該当位置だけを差し替え、ページ取得はスライスで済ませる。
+    """
+
+    def __init__(self, scores=()):
+        self._scores = dict(scores)
+        self._order = sorted((-value, uid) for uid, value in self._scores.items())
+
+    def __len__(self):
+        return len(self._order)
+
+    def set(self, uid, value):
+        old = self._scores.get(uid)
+        if old == value:
+            return
+        if old is not None:
+            del self._order[bisect.bisect_left(self._order, (-old, uid))]
+        self._scores[uid] = value
+        bisect.insort(self._order, (-value, uid))
+
+    def remove(self, uid):
+        old = self._scores.pop(uid, None)
+        if old is not None:
+            del self._order[bisect.bisect_left(self._order, (-old, uid))]
+
+    def page(self, page, size=RANK_PAGE_SIZE):
+        """[(順位, オーナーID, スコア), ...] を返す"""
+        start = (page - 1) * size
+        return [(start + i + 1, uid, -neg) for i, (neg, uid) in enumerate(self._order[start:start + size])]
+
+
+class Leaderboards:
+    """
+    通算（owners の balance / wins）とシーズン別（data["rankings"]）のランキング。
+    通算は owners から、シーズン別は保存済みの集計から初回参照時に組み立て、
+    以降は adjust_owner() 経由の増減だけで更新する（保存しない派生索引）。
+    """
+
+    def __init__(self, data):
+        self._data = data
+        self._boards = {}
+
+    def board(self, category, season=None):
+        key = (season, category)
+        if key not in self._boards:
+            if season is None:
+                scores = {uid: o.get("balance" if category == "prize" else "wins", 0)
+                          for uid, o in self._data["owners"].items() if uid != BOT_OWNER_ID}
+            else:
+                rankings = self._data.get("rankings", {})
+                # 集計のないシーズンのボードを作ってキャッシュを増やさない（今シーズンは集計前でもよい）
+                if season not in rankings and season != season_id(self._data):
+                    raise KeyError(season)
+                scores = rankings.get(season, {}).get(category, {})
+            self._boards[key] = Board(scores)
+        return self._boards[key]
+
+    def add_owner(self, uid):
+        if uid == BOT_OWNER_ID:
+            return
+        for category in RANK_CATEGORIES:
+            if (None, category) in self._boards:
+                self._boards[(None, category)].set(uid, 0)
+
+    def remove_owner(self, uid):
+        for board in self._boards.values():
+            board.remove(uid)
+
+    def record(self, uid, balance=0, wins=0):
+        """adjust_owner() で増減した後に呼ぶ。シーズン別の集計も更新する"""
+        if uid == BOT_OWNER_ID:
+            return
+        owner = self._data["owners"][uid]
+        season = season_id(self._data)
+        rankings = self._data.setdefault("rankings", {})
+        if season not in rankings:
+            rankings[season] = {category: {} for category in RANK_CATEGORIES}
+        for category, delta, total in (("prize", balance, owner.get("balance", 0)),
+                                       ("wins", wins, owner.get("wins", 0))):
+            if (None, category) in self._boards:
+                self._boards[(None, category)].set(uid, total)
+            if not delta:
+                continue
+            season_scores = rankings[season][category]
+            season_scores[uid] = season_scores.get(uid, 0) + delta
+            if (season, category) in self._boards:
+                self._boards[(season, category)].set(uid, season_scores[uid])
+
+
+def leaderboards(data):
+    """状態に対応する Leaderboards を返す（RacingState では索引を使い回す）"""
+    indexes = getattr(data, "indexes", None)
+    if indexes is None:
+        return Leaderboards(data)
+    if "leaderboards" not in indexes:
+        indexes["leaderboards"] = Leaderboards(data)
+    return indexes["leaderboards"]
 
 # データ整合性を保つためのヘルパー関数
 def _clean_pending_entry(data, horse_id):
@@ -436,32 +2377,51 @@ def _clean_pending_entry(data, horse_id):
     指定された馬IDを、すべてのpending_entriesリストから削除します。
     馬を引退させる際に呼び出し、参照エラーを防ぎます。
     """
-    cleaned = False
-    if "pending_entries" in data:
-        # pending_entriesは {day_key: [horse_id, ...]} の形式
-        for day_key in list(data["pending_entries"].keys()):
-            if horse_id in data["pending_entries"][day_key]:
-                data["pending_entries"][day_key].remove(horse_id)
-                cleaned = True
-            # エントリーリストが空になったらキー自体を削除
-            if not data["pending_entries"][day_key]:
-                del data["pending_entries"][day_key]
-    return cleaned
+    return entry_book(data).remove_horses([horse_id]) > 0
+
+def compact_state(data):
+    """
+    状態から不要になったデータを取り除き、削除件数を返す。
+    ・過去のGⅠで補充され data["horses"] に残っていたBot馬
+    ・存在しない馬を指すエントリーやオーナーの所有リスト
+    """
+    removed = 0
+
+    for hid in [hid for hid, horse in data["horses"].items() if horse.get("owner") == BOT_OWNER_ID]:
+        del data["horses"][hid]
+        horse_index(data).remove(hid)
+        removed += 1
+
+    book = entry_book(data)
+    dead = [hid for day_key in list(data.get("pending_entries", {}))
+            for hid in book.entries(day_key) if hid not in data["horses"]]
+    removed += book.remove_horses(dead)
+
+    for owner in data["owners"].values():
+        alive = [hid for hid in owner.get("horses", []) if hid in data["horses"]]
+        if len(alive) != len(owner.get("horses", [])):
+            removed += len(owner["horses"]) - len(alive)
+            owner["horses"] = alive
+
+    # Bot用オーナーは集計対象外
+    if BOT_OWNER_ID in data["owners"]:
+        del data["owners"][BOT_OWNER_ID]
+        leaderboards(data).remove_owner(BOT_OWNER_ID)
+        removed += 1
+
+    return removed
 
 # 一括エントリー処理のコアロジック
-async def _perform_bulk_entry(ctx, data, target_horses, entry_type):
-    uid = str(ctx.author.id)
+def _perform_bulk_entry(data, uid, target_horses, entry_type):
+    """一括エントリーを行い、返信メッセージを返す（ライタータスク内で実行される）"""
     current_day = data["season"]["day"]
     current_day_str = str(current_day)
     
     # 1. GⅠ開催日チェック
     if current_day > MAX_G1_DAY:
-         await ctx.reply(f"本日({current_day}日)はGⅠ開催日ではないため、エントリーできません。")
-         return
+         return f"本日({current_day}日)はGⅠ開催日ではないため、エントリーできません。"
 
-    pending = data.get("pending_entries", {})
-    if current_day_str not in pending:
-        pending[current_day_str] = []
+    book = entry_book(data)
         
     # 2. 処理対象となる馬のリストを作成 (疲労 < 8 の馬のみ)
     eligible_horses = []
@@ -477,81 +2437,397 @@ async def _perform_bulk_entry(ctx, data, target_horses, entry_type):
     # 3. 上限チェック (厳格: 5頭以上当てはまる場合は拒否)
     if len(eligible_horses) > MAX_ENTRIES_PER_WEEK:
         horse_names = [data["horses"][hid]["name"] for hid in eligible_horses]
-        await ctx.reply(
+        return (
             f"⚠️ **一括登録失敗**: あなたの厩舎には出走可能な馬が**{len(eligible_horses)}頭**います。\n"
             f"一括登録の上限**{MAX_ENTRIES_PER_WEEK}頭**を超過しているため、登録をキャンセルしました。\n"
             f"**対象馬**: {', '.join(horse_names)}"
         )
-        return
         
     # 4. 登録処理
     registered_count = 0
     already_entered_count = 0
     
     for hid in eligible_horses:
-        if hid in pending[current_day_str]:
+        # 登録実行（登録済みならスキップ）
+        if not book.add(current_day_str, hid):
             already_entered_count += 1
             continue
             
-        # 登録実行
-        pending[current_day_str].append(hid)
         registered_count += 1
-
-    data["pending_entries"] = pending
-    await save_data(data)
     
     # 5. 結果報告
     if registered_count == 0 and already_entered_count == 0:
-        await ctx.reply(f"ℹ️ {entry_type}に該当し、出走可能な馬（疲労8未満）はいませんでした。")
+        return f"ℹ️ {entry_type}に該当し、出走可能な馬（疲労8未満）はいませんでした。"
     elif registered_count == 0 and already_entered_count > 0:
-         await ctx.reply(f"✅ {entry_type}に該当する馬は全てすでに本日のレースにエントリー済みです (**{already_entered_count}頭**)。")
+         return f"✅ {entry_type}に該当する馬は全てすでに本日のレースにエントリー済みです (**{already_entered_count}頭**)。"
     else:
         status_msg = f"✅ {entry_type}の馬**{registered_count}頭**を本日のレースに出走登録しました。"
         if already_entered_count > 0:
              status_msg += f" (うち{already_entered_count}頭は既に登録済みでした)"
-        await ctx.reply(status_msg)
+        return status_msg
 
 
-# ----------------- コマンド -----------------
+# --------------- 表示名の解決 ---------------
 
-@bot.command(name="racehistory", help="馬の過去のレース結果を表示します: 例) !racehistory H12345")
-async def racehistory(ctx, horse_id: str):
-    data = await load_data()
-    horse = data["horses"].get(horse_id)
+# 取得できた表示名・取得に失敗したIDを覚えておく時間（秒）
+NAME_CACHE_TTL = 600
+NAME_NEGATIVE_TTL = 60
+NAME_CACHE_SIZE = 1024
+# fetch_user を同時に投げる上限（レート制限対策）
+NAME_FETCH_CONCURRENCY = 5
 
-    if not horse:
-        await ctx.reply("そのIDの馬は存在しません。")
-        return
+class NameResolver:
+    """
+    DiscordユーザーIDから表示名を引く。
+    ・結果は TTL 付きの LRU キャッシュに保持（失敗も短い TTL で覚えておく）
+    ・同じIDの取得が同時に走った場合は1回の fetch_user にまとめる
+    ・複数IDはまとめて並行に取得する（同時実行数は上限あり）
+    """
 
-    if horse["owner"] == BOT_OWNER_ID:
-        await ctx.reply("このコマンドでは協会生産馬の履歴は確認できません。")
-        return
+    def __init__(self):
+        self._cache = OrderedDict()
+        self._inflight = {}
+        self._semaphore = asyncio.Semaphore(NAME_FETCH_CONCURRENCY)
 
-    if not horse.get("history"):
-        await ctx.reply(f"{horse['name']} はまだレースに出走していません。")
-        return
+    def _remember(self, user_id, name):
+        ttl = NAME_CACHE_TTL if name is not None else NAME_NEGATIVE_TTL
+        self._cache[user_id] = (name, asyncio.get_running_loop().time() + ttl)
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > NAME_CACHE_SIZE:
+            self._cache.popitem(last=False)
 
-    lines = [f"{horse['name']} のレース履歴:"]
-    for r in horse["history"]:
-        # 履歴データには month と day が含まれるようになった
-        day = r.get('day', 'N/A')
-        month = r.get('month', 'N/A')
-        year = r.get('year', 'N/A')
-        lines.append(
-            f" - {year}年 {month}月 第{day}週 {r['race']} ({r['pos']}着) "
-            f"賞金:{r['prize']} (スコア:{r['score']:.2f})"
-        )
-    await ctx.reply("\n".join(lines))
+    async def _fetch(self, user_id):
+        try:
+            async with self._semaphore:
+                with METRICS.timer("racing_discord_seconds", call="fetch_user"):
+                    user = await bot.fetch_user(int(user_id))
+            name = user.display_name
+        except Exception:
+            name = None
+        self._remember(user_id, name)
+        return name
+
+    async def resolve(self, user_id):
+        """表示名を返す。取得できなければ None"""
+        user_id = str(user_id)
+        cached = self._cache.get(user_id)
+        if cached and cached[1] > asyncio.get_running_loop().time():
+            self._cache.move_to_end(user_id)
+            return cached[0]
 
-@bot.command(name="raceresults", help="過去のレース全結果を表示します: 例) !raceresults 2024 1 1 (2024年1月 第1週のレース)")
-async def raceresults(ctx, year: int, month: int, day: int):
-    data = await load_data()
-    
-    # 指定された年、月、日のレース結果を検索
-    found_races = [
-        r for r in data["races"] 
-        if r.get("year") == year and r.get("month") == month and r.get("day") == day
-    ]
+        try:
+            user = bot.get_user(int(user_id))
+        except ValueError:
+            user = None
+        if user is not None:
+            self._remember(user_id, user.display_name)
+            return user.display_name
+
+        task = self._inflight.get(user_id)
+        if task is None:
+            task = asyncio.create_task(self._fetch(user_id))
+            self._inflight[user_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(user_id, None))
+        return await asyncio.shield(task)
+
+    async def resolve_many(self, user_ids):
+        """{ユーザーID: 表示名 or None} を返す"""
+        user_ids = list(dict.fromkeys(str(uid) for uid in user_ids))
+        names = await asyncio.gather(*(self.resolve(uid) for uid in user_ids))
+        return dict(zip(user_ids, names))
+
+
+NAMES = NameResolver()
+
+
+# --------------- レート制限・同時リクエストの集約 ---------------
+
+# キーごとのバケットを覚えておく上限（古いものから忘れる＝満タンに戻る）
+TOKEN_BUCKET_KEYS = 4096
+
+class TokenBuckets:
+    """
+    キーごとのトークンバケット。capacity 個まで貯まり、window 秒で capacity 個回復する。
+    window が 0 以下なら制限しない。
+    """
+
+    def __init__(self, capacity, window):
+        self.capacity = capacity
+        self.window = window
+        self._buckets = OrderedDict()
+
+    def _level(self, key, now):
+        tokens, updated = self._buckets.get(key, (self.capacity, now))
+        return min(self.capacity, tokens + (now - updated) * self.capacity / self.window)
+
+    def _store(self, key, tokens, now):
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > TOKEN_BUCKET_KEYS:
+            self._buckets.popitem(last=False)
+
+    def available(self, key):
+        """トークンが1つ以上残っているか（使わずに確認するだけ）"""
+        if self.window <= 0:
+            return True
+        return self._level(key, asyncio.get_running_loop().time()) >= 1
+
+    def try_take(self, key):
+        """トークンがあれば1つ使って True、なければ何もせず False"""
+        if self.window <= 0:
+            return True
+        now = asyncio.get_running_loop().time()
+        tokens = self._level(key, now)
+        if tokens < 1:
+            return False
+        self._store(key, tokens - 1, now)
+        return True
+
+    def reserve(self, key):
+        """トークンを1つ予約し、使えるようになるまでの待ち時間（秒）を返す"""
+        if self.window <= 0:
+            return 0.0
+        now = asyncio.get_running_loop().time()
+        tokens = self._level(key, now) - 1
+        self._store(key, tokens, now)
+        return max(0.0, -tokens * self.window / self.capacity)
+
+class Coalescer:
+    """同じキーの処理が同時に走った場合、最初の1回の結果を全員で共有する"""
+
+    def __init__(self):
+        self._inflight = {}
+
+    async def run(self, key, factory):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+
+# --------------- メッセージ送信 ---------------
+
+# Discord の1メッセージあたりの文字数上限
+MESSAGE_LIMIT = 2000
+# 表を1ページに描画する最大行数（上限を超える場合はさらに分ける）
+TABLE_PAGE_ROWS = 20
+# チャンネルごとの送信レート（SEND_BURST 通 / SEND_WINDOW_SECONDS 秒）
+SEND_BURST = 5
+SEND_WINDOW_SECONDS = 5.0
+
+def chunk_lines(lines, limit=MESSAGE_LIMIT):
+    """行のリストを、改行で連結しても limit 文字に収まるメッセージに詰めて分ける"""
+    chunks = []
+    current = []
+    size = 0
+    for line in lines:
+        # 1行で上限を超える場合は文字数で切る
+        for piece in [line[i:i + limit] for i in range(0, len(line), limit)] or [""]:
+            extra = len(piece) + (1 if current else 0)
+            if current and size + extra > limit:
+                chunks.append("\n".join(current))
+                current = []
+                size = 0
+                extra = len(piece)
+            current.append(piece)
+            size += extra
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+def table_pages(header, body, style=PresetStyle.thin_compact, limit=MESSAGE_LIMIT):
+    """t2a の表を、コードブロックに包んでも limit 文字に収まる行数ずつ描画する"""
+    pages = []
+    rows = TABLE_PAGE_ROWS
+    start = 0
+    while start < len(body):
+        page_body = body[start:start + rows]
+        text = "```" + t2a(header=header, body=page_body, style=style) + "```"
+        if len(text) > limit and len(page_body) > 1:
+            rows = max(1, len(page_body) // 2)
+            continue
+        pages.append(text)
+        start += len(page_body)
+    return pages
+
+class MessageSender:
+    """
+    分割済みのメッセージを送信先ごとに順番に送る。
+    ・送信先ごとのロックがキューの役割をし、複数の送信が混ざらない
+    ・送信先ごとのトークンバケットで間隔を調整し、レート制限に当たらないようにする
+    ・1通の送信に失敗しても残りは送る
+    """
+
+    def __init__(self, burst=SEND_BURST, window=SEND_WINDOW_SECONDS):
+        self._locks = {}
+        # window=0 なら送信間隔の調整なし（シミュレーター用）
+        self._buckets = TokenBuckets(burst, window)
+
+    async def send(self, key, send, chunks):
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            for chunk in chunks:
+                delay = self._buckets.reserve(key)
+                if delay:
+                    await asyncio.sleep(delay)
+                try:
+                    with METRICS.timer("racing_discord_seconds", call="send"):
+                        await send(chunk)
+                except discord.HTTPException as e:
+                    print(f"Failed to send message to {key}: {e}")
+
+
+SENDER = MessageSender()
+
+async def send_lines(channel, lines):
+    """行のリストをチャンネルに分割送信する"""
+    await SENDER.send(channel.id, channel.send, chunk_lines(lines))
+
+async def reply_lines(ctx, lines):
+    """行のリストをコマンドへの返信として分割送信する"""
+    await SENDER.send(ctx.channel.id, ctx.reply, chunk_lines(lines))
+
+
+# --------------- 表示のキャッシュ ---------------
+
+RENDER_CACHE_SIZE = 32
+# オーナーの表示名を含むため、表示名キャッシュと同じ時間で期限切れにする
+RENDER_CACHE_TTL = NAME_CACHE_TTL
+
+class RenderCache:
+    """
+    !odds・!entries の描画結果（送信する行のリスト）を保持する。
+    キーには日と EntryBook の版を含めるため、エントリーや出走馬の値が変われば自然に使われなくなる。
+    """
+
+    def __init__(self):
+        self._cache = OrderedDict()
+        self._builds = Coalescer()
+
+    def get(self, key):
+        cached = self._cache.get(key)
+        if cached is None or cached[1] <= asyncio.get_running_loop().time():
+            return None
+        self._cache.move_to_end(key)
+        return cached[0]
+
+    def put(self, key, lines):
+        self._cache[key] = (lines, asyncio.get_running_loop().time() + RENDER_CACHE_TTL)
+        self._cache.move_to_end(key)
+        while len(self._cache) > RENDER_CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    async def render(self, key, build):
+        """
+        キャッシュがあればそれを、なければ build() の結果を返す。
+        同じキーの描画が同時に要求された場合は1回だけ描画して共有する。
+        """
+        lines = self.get(key)
+        if lines is not None:
+            return lines
+        return await self._builds.run(key, lambda: self._build(key, build))
+
+    async def _build(self, key, build):
+        lines = await build()
+        self.put(key, lines)
+        return lines
+
+    def clear_cache(self):
+        self._cache.clear()
+
+
+RENDERED = RenderCache()
+
+
+# --------------- コマンドの流量制御 ---------------
+
+# コマンドの種類（ここにないコマンドは "write"）。None は制限しない（管理者用）
+COMMAND_CLASSES = {
+    "odds": "read", "entries": "read", "rank": "read", "myhorses": "read", "schedule": "read",
+    "balance": "read", "racehistory": "read", "raceresults": "read", "horseresults": "read",
+    "forcerace": None, "nextday": None, "resetdata": None, "confirmreset": None, "setannounce": None,
+}
+# 種類ごとの上限（回数, 秒）。ユーザーごと・サーバーごとに数える
+USER_COMMAND_LIMITS = {"read": (5, 10.0), "write": (10, 10.0)}
+GUILD_COMMAND_LIMITS = {"read": (30, 10.0), "write": (60, 10.0)}
+
+class AdmissionControl:
+    """
+    コマンドを実行する前に、ユーザーごと・サーバーごとのトークンバケットで流量を制限する。
+    上限を超えたコマンドは状態の読み込みや Discord API の呼び出しより前に捨てる。
+    断ったことは連続して超過している間に1回だけ伝える。
+    """
+
+    def __init__(self):
+        self._users = {cls: TokenBuckets(*limit) for cls, limit in USER_COMMAND_LIMITS.items()}
+        self._guilds = {cls: TokenBuckets(*limit) for cls, limit in GUILD_COMMAND_LIMITS.items()}
+        self._warned = set()
+
+    def admit(self, ctx):
+        """(実行してよいか, 断ったことを伝えるべきか)"""
+        cls = COMMAND_CLASSES.get(ctx.command.name, "write")
+        if cls is None:
+            return True, False
+
+        user_key = (cls, ctx.author.id)
+        users = self._users[cls]
+        guilds = self._guilds[cls] if ctx.guild is not None else None
+        # 両方のバケットに空きがあるときだけ両方から使う（サーバー側で断ったのにユーザーの分を減らさない）
+        admitted = users.available(user_key) and (guilds is None or guilds.available(ctx.guild.id))
+
+        if admitted:
+            users.try_take(user_key)
+            if guilds is not None:
+                guilds.try_take(ctx.guild.id)
+            self._warned.discard(user_key)
+            return True, False
+        if user_key in self._warned:
+            return False, False
+        self._warned.add(user_key)
+        return False, True
+
+
+ADMISSION = AdmissionControl()
+
+# ----------------- コマンド -----------------
+
+@bot.command(name="racehistory", help="馬の過去のレース結果を表示します: 例) !racehistory H12345")
+async def racehistory(ctx, horse_id: str):
+    data = await load_data()
+    horse = data["horses"].get(horse_id)
+
+    if not horse:
+        await ctx.reply("そのIDの馬は存在しません。")
+        return
+
+    if horse["owner"] == BOT_OWNER_ID:
+        await ctx.reply("このコマンドでは協会生産馬の履歴は確認できません。")
+        return
+
+    history = await HISTORY.load(horse_id) if race_count(horse) else []
+    if not history:
+        await ctx.reply(f"{horse['name']} はまだレースに出走していません。")
+        return
+
+    lines = [f"{horse['name']} のレース履歴:"]
+    for r in history:
+        # 履歴データには month と day が含まれるようになった
+        day = r.get('day', 'N/A')
+        month = r.get('month', 'N/A')
+        year = r.get('year', 'N/A')
+        line = f" - {year}年 {month}月 第{day}週 {r['race']} ({r['pos']}着) 賞金:{r['prize']}"
+        # 古い履歴にはスコアが記録されていない
+        if r.get('score') is not None:
+            line += f" (スコア:{r['score']:.2f})"
+        lines.append(line)
+    await reply_lines(ctx, lines)
+
+@bot.command(name="raceresults", help="過去のレース全結果を表示します: 例) !raceresults 2024 1 1 (2024年1月 第1週のレース)")
+async def raceresults(ctx, year: int, month: int, day: int):
+    # 指定された年、月、日のレース結果をアーカイブから取得
+    found_races = await RESULTS.races_on(year, month, day)
     
     if not found_races:
         await ctx.reply(f"{year}年{month}月 第{day}週 に開催されたレースの結果は見つかりませんでした。\n(レースは開催日と開催順に記録されます)")
@@ -560,54 +2836,70 @@ async def raceresults(ctx, year: int, month: int, day: int):
     response_lines = []
         
     for race in found_races:
-        race_info = {
-            "name": race["name"],
-            "distance": race["distance"],
-            "track": race["track"]
-        }
-        results = race["results"]
-        entries_count = len(results)
-        
-        # 結果表示のヘッダー
-        msg_lines = [
-            "========================",
-            f"**🏆 {race_info['name']} 結果 ({year}年{month}月 第{day}週)**",
-            f"距離: {race_info['distance']}m / 馬場: {race_info['track']} / **{entries_count}頭立て**",
-            "------------------------"
-        ]
-        
-        # 賞金が付く順位を決定 (GⅠは5着まで、下級レースは3着まで)
-        # GⅠは名前に 'GⅠ' が含まれることで判定
-        prize_count = 5 if race_info['name'].startswith("GⅠ") else 3
-
-        for r in results:
-            owner_display = ""
-            if r['owner'] == BOT_OWNER_ID:
-                owner_display = "**協会生産**"
-            else:
-                # オーナーのDiscord表示名を取得
-                try:
-                    owner_user = bot.get_user(int(r['owner'])) or await bot.fetch_user(int(r['owner']))
-                    owner_display = owner_user.display_name
-                except:
-                    owner_display = f"ID:{r['owner']}" # 取得できない場合はIDを表示
-            
-            line = f"**{r['pos']}着** ({r['post_position']}番) **{r['horse_name']}** (オーナー:{owner_display})"
-            
-            # race_historyにはscoreが保存されているが、race_resultsには保存されていないため、prizeのみ表示
-            if r.get('prize', 0) > 0:
-                 line += f" 賞金:{r['prize']}" 
-            
-            msg_lines.append(line)
-        
-        response_lines.extend(msg_lines)
+        response_lines.extend(await _race_result_lines(race))
         response_lines.append("\n") # レース間に空白行を追加
     
     # 最後の空行を削除
     if response_lines and response_lines[-1] == "\n":
         response_lines.pop()
 
-    await ctx.reply("\n".join(response_lines))
+    await reply_lines(ctx, response_lines)
+
+@bot.command(name="horseresults", help="馬が出走したレースの全結果を新しい順に表示します: 例) !horseresults H12345 2")
+async def horseresults(ctx, horse_id: str, page: int = 1):
+    if page < 1:
+        await ctx.reply("ページ番号は1以上で指定してください。")
+        return
+
+    found_races = await RESULTS.races_of_horse(horse_id, page)
+    if not found_races:
+        await ctx.reply(f"ID:{horse_id} のレース結果は見つかりませんでした。（{page}ページ目）")
+        return
+
+    response_lines = [f"📜 **ID:{horse_id} の出走レース** （{page}ページ目）"]
+    for race in found_races:
+        response_lines.extend(await _race_result_lines(race))
+
+    await reply_lines(ctx, response_lines)
+
+async def _race_result_lines(race):
+    """アーカイブされたレース1件分の表示行を作る"""
+    year, month, day = race["year"], race["month"], race["day"]
+    race_info = {
+        "name": race["name"],
+        "distance": race["distance"],
+        "track": race["track"]
+    }
+    results = race["results"]
+    entries_count = len(results)
+    
+    # 結果表示のヘッダー
+    msg_lines = [
+        "========================",
+        f"**🏆 {race_info['name']} 結果 ({year}年{month}月 第{day}週)**",
+        f"距離: {race_info['distance']}m / 馬場: {race_info['track']} / **{entries_count}頭立て**",
+        "------------------------"
+    ]
+
+    # オーナーのDiscord表示名をまとめて取得
+    names = await NAMES.resolve_many(r['owner'] for r in results if r['owner'] != BOT_OWNER_ID)
+
+    for r in results:
+        owner_display = ""
+        if r['owner'] == BOT_OWNER_ID:
+            owner_display = "**協会生産**"
+        else:
+            owner_display = names.get(r['owner']) or f"ID:{r['owner']}" # 取得できない場合はIDを表示
+        
+        line = f"**{r['pos']}着** ({r['post_position']}番) **{r['horse_name']}** (オーナー:{owner_display})"
+        
+        # 賞金を獲得した馬のみ賞金を表示
+        if r.get('prize', 0) > 0:
+             line += f" 賞金:{r['prize']}" 
+        
+        msg_lines.append(line)
+
+    return msg_lines
 
 @bot.command(name="forcerace", help="[管理]現在の日付で強制的にレースを実行します")
 @commands.has_permissions(administrator=True) # <-- 追加
@@ -619,8 +2911,7 @@ async def forcerace(ctx):
     current_year = data["season"]["year"]
     current_day_str = str(current_day)
 
-    entries = data.get("pending_entries", {}).get(current_day_str, [])
-    if not entries:
+    if not entry_book(data).count(current_day_str):
         await ctx.reply("本日は出走馬がいないため、レースを実行できません。")
         return
 
@@ -633,95 +2924,101 @@ async def forcerace(ctx):
 
     await ctx.reply("🏁 レースを実行し、日付を進めました。")
 
-@bot.command(name="bet", help="出走馬に賭けます （例: !bet H12345 1000）")
-async def bet(ctx, horse_id: str, amount: int):
-    data = await load_data()
-    uid = str(ctx.author.id)
-
-    owner = get_owner(data, uid)
-
-    if amount <= 0:
-        await ctx.reply("賭け金は正の整数で指定してください。")
-        return
-
-    if owner["balance"] < amount:
-        await ctx.reply("所持金が足りません。")
-        return
-
-    # 出走確認
-    today = str(data["season"]["day"])
-    entries = data.get("pending_entries", {}).get(today, [])
-    if horse_id not in entries:
-        await ctx.reply("その馬は本日のレースに出走していません。")
-        return
-
-    # オッズ計算
-    horse = data["horses"][horse_id]
-    odds = calculate_odds(horse)
-
-    data.setdefault("bets", {})
-    day = str(data["season"]["day"])
-    data.setdefault("bets", {})
-    data["bets"].setdefault(day, {})
-    data["bets"][day][uid] = {
-        "horse_id": horse_id,
-        "amount": amount,
-        "odds": odds
-    }
-
-    owner["balance"] -= amount
-    await save_data(data)
+@bot.command(name="bet", help="出走馬に賭けます （例: !bet H12345 1000 / !bet H12345 1000 place / !bet H12345 1000 quinella H67890）")
+async def bet(ctx, horse_id: str, amount: int, bet_type: str = "win", second_horse_id: str = None):
+    def op(data):
+        uid = str(ctx.author.id)
+
+        owner = get_owner(data, uid)
+
+        if bet_type not in BET_TYPES:
+            return "券種は win（単勝） / place（複勝） / quinella（馬連） のいずれかを指定してください。"
+
+        if amount <= 0:
+            return "賭け金は正の整数で指定してください。"
+
+        if owner["balance"] < amount:
+            return "所持金が足りません。"
+
+        # 出走確認
+        today = str(data["season"]["day"])
+        book = entry_book(data)
+        if not book.contains(today, horse_id):
+            return "その馬は本日のレースに出走していません。"
+
+        horse = data["horses"][horse_id]
+        selection = horse_id
+        label = horse["name"]
+        if bet_type == "quinella":
+            if not second_horse_id or second_horse_id == horse_id:
+                return "馬連は異なる2頭を指定してください。例) `!bet H12345 1000 quinella H67890`"
+            if not book.contains(today, second_horse_id):
+                return "2頭目の馬は本日のレースに出走していません。"
+            selection = quinella_key(horse_id, second_horse_id)
+            label = f"{horse['name']} - {data['horses'][second_horse_id]['name']}"
+
+        pool = bet_pool(data, today)
+        add_ticket(pool, uid, bet_type, selection, amount)
+        adjust_owner(data, uid, balance=-amount)
+
+        return (
+            f"🐎 {BET_TYPES[bet_type]} {label} に賭けました\n"
+            f"金額: {amount}\n"
+            f"現在のオッズ: {pool_odds(pool, bet_type, selection)} 倍（締切まで変動します）\n"
+        )
 
-    payout = int(amount * odds)
-    horse = data["horses"][horse_id]
-    odds_val = calculate_odds(horse)
-    await ctx.reply(
-        f"🐎 {horse['name']} に賭けました\n"
-        f"金額: {amount}\n"
-        f"オッズ: {odds_val} 倍\n"
-    )
+    await ctx.reply(await mutate(op))
 
 @bot.command(name="odds", help="本日の出走馬オッズ一覧を表示します")
 async def odds(ctx):
     data = await load_data()
 
     day = str(data["season"]["day"])
-    entries = data.get("pending_entries", {}).get(day, [])
+    book = entry_book(data)
+    # オッズの計算中に登録が増減しても表示対象は変えない
+    entries = list(book.entries(day))
     if not entries:
         await ctx.reply("本日の出走馬がいません。")
         return
 
-    odds_table = []
-    for hid in entries:
-        horse = data["horses"].get(hid)
-        if not horse:
-            continue
+    pool = as_pool(data.get("bets", {}).get(day))
+    # 票数は賭けるたびに増えるため、合計票数をキーに含めれば払い戻し倍率の変化も反映される
+    cache_key = ("odds", data["season"]["year"], data["season"]["month"], day,
+                 book.version(day), tuple(pool["totals"].values()))
 
-        odds_val = calculate_odds(horse)
+    async def build():
+        # シミュレーションはスレッドで行い、イベントループを止めない
+        field_odds = await ODDS.fetch(data, day)
 
-        cut_name = cut_horse_name(horse["name"])  # ← ここで生成
+        odds_table = []
+        for hid in entries:
+            horse = data["horses"].get(hid)
+            if not horse:
+                continue
 
-        odds_table.append([
-            hid,
-            cut_name,
-            horse.get("wins", 0),
-            odds_val
-        ])
+            cut_name = cut_horse_name(horse["name"])  # ← ここで生成
 
-    if not odds_table:
-        await ctx.reply("オッズを表示する出走馬がいません。")
-        return
+            odds_table.append([
+                hid,
+                cut_name,
+                horse.get("wins", 0),
+                field_odds.get(hid, "-"),
+                pool_odds(pool, "win", hid) or "-",
+                pool_odds(pool, "place", hid) or "-"
+            ])
 
-    ascii_table = t2a(
-        header=["馬ID", "馬名", "勝利数", "オッズ"],
-        body=odds_table,
-        style=PresetStyle.thin_compact
-    )
+        if not odds_table:
+            return ["オッズを表示する出走馬がいません。"]
+
+        pages = table_pages(["馬ID", "馬名", "勝利数", "予想", "単勝", "複勝"], odds_table)
+        return ["🏇 **本日のオッズ**（予想: シミュレーションによる勝率から / 単勝・複勝: 現在の票数から）"] + pages
 
-    await ctx.reply("🏇 **本日のオッズ**\n```" + ascii_table + "```")
+    # 同じ表示は使い回し、同時に要求された場合も描画は1回にまとめる
+    await reply_lines(ctx, await RENDERED.render(cache_key, build))
 
 @bot.command(name="nextday", help="[管理]日付を1日進めます（レース処理なし）")
 @commands.has_permissions(administrator=True) # <-- 追加
+@serialized
 async def next_day(ctx):
     data = await load_data()
 
@@ -733,7 +3030,7 @@ async def next_day(ctx):
 
     # 未処理データの掃除（任意だが推奨）
     current_day_str = str(data["season"]["day"])
-    data.get("pending_entries", {}).pop(current_day_str, None)
+    entry_book(data).clear_day(current_day_str)
     data.get("bets", {}).pop(current_day_str, None)
 
     # 日付を進める（既存関数を利用）
@@ -773,6 +3070,7 @@ async def resetdata(ctx):
 
 @bot.command(name="confirmreset", help="[管理] !resetdataの実行を確定します")
 @commands.has_permissions(administrator=True) 
+@serialized
 async def confirmreset(ctx):
     global PENDING_RESETS
     
@@ -789,166 +3087,173 @@ async def confirmreset(ctx):
         await ctx.reply("リセット確認の期限（10秒）が過ぎました。再度 `!resetdata` を実行してください。")
         return
 
-    # Supabaseのデータを削除
-    supabase.table("kv_store").delete().eq("key", DATA_KEY).execute()
+    # ストレージのデータを削除してから、メモリ上の状態を破棄する（STATE_LOCK は @serialized で保持済み）
+    await STATE.discard(_delete_data)
+    RESULTS.clear_cache()
+    ODDS.clear_cache()
+    HISTORY.clear_cache()
+    RENDERED.clear_cache()
     
-    await ctx.reply("✅ **データファイルを削除しました。** Botを再起動すると新しい状態で始まります。")
+    await ctx.reply("✅ **データファイルを削除しました。** 次のコマンドから新しい状態で始まります。")
     
 @bot.command(name="setannounce", help="[管理] レース結果を告知するチャンネルを設定します")
 @commands.has_permissions(administrator=True)
 async def setannounce(ctx, channel: discord.TextChannel):
-    data = await load_data()
-    data["announce_channel"] = channel.id
-    await save_data(data)
-    await ctx.reply(f"告知チャンネルを {channel.mention} に設定しました。")
+    def op(data):
+        data["announce_channel"] = channel.id
+        return f"告知チャンネルを {channel.mention} に設定しました。"
+
+    await ctx.reply(await mutate(op))
 
 @bot.command(name="newhorse", help="新馬抽選：あなたの厩舎に新しい馬を追加します")
 async def newhorse(ctx, name: str):
-    data = await load_data()
-    uid = str(ctx.author.id)
-
-    if uid not in data["owners"]:
-        data["owners"][uid] = {"horses": [], "balance": 0, "wins": 0}
-
-    if len(data["owners"][uid]["horses"]) >= MAX_HORSES_PER_OWNER:
-        await ctx.reply(f"最大保有頭数**{MAX_HORSES_PER_OWNER}頭**を超えています。`!retire <ID>` または `!massretire` で馬を引退させてください。")
-        return
-
-    horse_id = new_horse_id(data)
-    stats = {
-        "speed": random.randint(50, 95),
-        "stamina": random.randint(50, 95),
-        "temper": random.randint(40, 90),
-        "growth": random.randint(40, 85),
-        "turf_apt": random.randint(50, 90), 
-        "dirt_apt": random.randint(50, 90), 
-    }
-    horse = {
-        "id": horse_id,
-        "name": name,
-        "owner": uid,
-        "stats": stats,
-        "age": 3,
-        "fatigue": 0,
-        "wins": 0,
-        "history": [],
-        "favorite": False,
-        "rest_used_day": -1 
-    }
+    def op(data):
+        uid = str(ctx.author.id)
+
+        get_owner(data, uid)
+
+        if len(data["owners"][uid]["horses"]) >= MAX_HORSES_PER_OWNER:
+            return f"最大保有頭数**{MAX_HORSES_PER_OWNER}頭**を超えています。`!retire <ID>` または `!massretire` で馬を引退させてください。"
+
+        horse_id = new_horse_id(data)
+        stats = {
+            "speed": random.randint(50, 95),
+            "stamina": random.randint(50, 95),
+            "temper": random.randint(40, 90),
+            "growth": random.randint(40, 85),
+            "turf_apt": random.randint(50, 90), 
+            "dirt_apt": random.randint(50, 90), 
+        }
+        horse = {
+            "id": horse_id,
+            "name": name,
+            "owner": uid,
+            "stats": stats,
+            "age": 3,
+            "fatigue": 0,
+            "wins": 0,
+            "race_count": 0,
+            "prize_total": 0,
+            "favorite": False,
+            "rest_used_day": -1 
+        }
 
-    data["horses"][horse_id] = horse
-    data["owners"][uid]["horses"].append(horse_id)
-    await save_data(data)
+        data["horses"][horse_id] = horse
+        data["owners"][uid]["horses"].append(horse_id)
+        horse_index(data).update(horse)
     
-    s = stats
-    await ctx.reply(
-        f"新馬抽選完了！\nID: {horse_id} / 名前: {name}\n"
-        f"ステータス: SPD {s['speed']} / STA {s['stamina']} / TEM {s['temper']} / GRW {s['growth']}\n"
-        f"適性: 芝 {s['turf_apt']} / ダート {s['dirt_apt']}\n"
-        f"お気に入り登録: {horse['favorite']}"
-    )
+        s = stats
+        return (
+            f"新馬抽選完了！\nID: {horse_id} / 名前: {name}\n"
+            f"ステータス: SPD {s['speed']} / STA {s['stamina']} / TEM {s['temper']} / GRW {s['growth']}\n"
+            f"適性: 芝 {s['turf_apt']} / ダート {s['dirt_apt']}\n"
+            f"お気に入り登録: {horse['favorite']}"
+        )
+
+    await ctx.reply(await mutate(op))
 
 @bot.command(name="retire", help="馬を引退させて厩舎から削除します: 例) !retire H12345")
 async def retire(ctx, horse_id: str):
-    data = await load_data()
-    uid = str(ctx.author.id)
-    horse = data["horses"].get(horse_id)
+    def op(data):
+        uid = str(ctx.author.id)
+        horse = data["horses"].get(horse_id)
 
-    if not horse:
-        await ctx.reply("そのIDの馬は存在しません。")
-        return
-    if horse["owner"] != uid:
-        await ctx.reply("これはあなたの馬ではありません。")
-        return
+        if not horse:
+            return "そのIDの馬は存在しません。"
+        if horse["owner"] != uid:
+            return "これはあなたの馬ではありません。"
     
-    # pending_entriesから馬IDを削除
-    _clean_pending_entry(data, horse_id) 
+        # pending_entriesから馬IDを削除
+        _clean_pending_entry(data, horse_id) 
     
-    data["owners"][uid]["horses"].remove(horse_id)
-    del data["horses"][horse_id]
+        data["owners"][uid]["horses"].remove(horse_id)
+        del data["horses"][horse_id]
+        horse_index(data).remove(horse_id)
+        HISTORY.discard(horse_id)
     
-    await save_data(data)
-    await ctx.reply(f"馬 **{horse['name']} (ID: {horse_id})** を引退させ、厩舎から削除しました。")
+        return f"馬 **{horse['name']} (ID: {horse_id})** を引退させ、厩舎から削除しました。"
+
+    await ctx.reply(await mutate(op))
 
 
 @bot.command(name="massretire", help="お気に入り以外の馬を全て引退させます (🚨要確認)")
 async def massretire(ctx):
-    data = await load_data()
-    uid = str(ctx.author.id)
-    owner = data["owners"].get(uid)
+    def op(data):
+        uid = str(ctx.author.id)
+        owner = data["owners"].get(uid)
     
-    if not owner or not owner["horses"]:
-        await ctx.reply("あなたの厩舎には馬がいません。")
-        return
+        if not owner or not owner["horses"]:
+            return "あなたの厩舎には馬がいません。"
 
-    to_retire = []
-    to_keep = []
+        to_retire = []
+        to_keep = []
     
-    # お気に入りでない馬を選別
-    for hid in owner["horses"]:
-        horse = data["horses"].get(hid)
-        if horse and not horse.get("favorite", False):
-            to_retire.append(hid)
-        elif horse:
-            to_keep.append(hid)
-
-    if not to_retire:
-        await ctx.reply("お気に入り登録されている馬しかいません。削除対象の馬がいません。")
-        return
+        # お気に入りでない馬を選別
+        for hid in owner["horses"]:
+            horse = data["horses"].get(hid)
+            if horse and not horse.get("favorite", False):
+                to_retire.append(hid)
+            elif horse:
+                to_keep.append(hid)
+
+        if not to_retire:
+            return "お気に入り登録されている馬しかいません。削除対象の馬がいません。"
         
-    # 削除実行
-    for hid in to_retire:
-        # pending_entriesから馬IDを削除
-        _clean_pending_entry(data, hid) 
-        if hid in data["horses"]:
-             del data["horses"][hid]
-    
-    # オーナーの馬リストを更新
-    data["owners"][uid]["horses"] = to_keep
+        # 削除実行
+        # pending_entriesから馬IDをまとめて削除
+        entry_book(data).remove_horses(to_retire)
+        for hid in to_retire:
+            if hid in data["horses"]:
+                 del data["horses"][hid]
+            horse_index(data).remove(hid)
+            HISTORY.discard(hid)
     
-    await save_data(data)
+        # オーナーの馬リストを更新
+        data["owners"][uid]["horses"] = to_keep
     
-    keep_names = [data["horses"][hid]["name"] for hid in to_keep]
+        keep_names = [data["horses"][hid]["name"] for hid in to_keep]
     
-    reply_msg = [
-        f"✅ **{len(to_retire)}頭**の馬を引退させました。",
-        "---",
-        f"現在厩舎に残っている馬 (**{len(to_keep)}頭**) (お気に入り):"
-    ]
-    if keep_names:
-        reply_msg.append(", ".join(keep_names))
-    else:
-        reply_msg.append("なし")
+        reply_msg = [
+            f"✅ **{len(to_retire)}頭**の馬を引退させました。",
+            "---",
+            f"現在厩舎に残っている馬 (**{len(to_keep)}頭**) (お気に入り):"
+        ]
+        if keep_names:
+            reply_msg.append(", ".join(keep_names))
+        else:
+            reply_msg.append("なし")
         
-    await ctx.reply("\n".join(reply_msg))
+        return "\n".join(reply_msg)
+
+    await ctx.reply(await mutate(op))
 
 @bot.command(name="favorite", help="馬をお気に入りに登録します (全削除除外対象): 例) !favorite H12345")
 async def favorite(ctx, horse_id: str):
-    data = await load_data()
-    uid = str(ctx.author.id)
-    horse = data["horses"].get(horse_id)
+    def op(data):
+        uid = str(ctx.author.id)
+        horse = data["horses"].get(horse_id)
     
-    if not horse or horse["owner"] != uid:
-        await ctx.reply("そのIDの馬は存在しないか、あなたの馬ではありません。")
-        return
+        if not horse or horse["owner"] != uid:
+            return "そのIDの馬は存在しないか、あなたの馬ではありません。"
     
-    horse["favorite"] = True
-    await save_data(data)
-    await ctx.reply(f"**{horse['name']}** をお気に入りに登録しました。`!massretire` の対象から除外されます。")
+        horse["favorite"] = True
+        return f"**{horse['name']}** をお気に入りに登録しました。`!massretire` の対象から除外されます。"
+
+    await ctx.reply(await mutate(op))
 
 @bot.command(name="unfavorite", help="馬のお気に入り登録を解除します: 例) !unfavorite H12345")
 async def unfavorite(ctx, horse_id: str):
-    data = await load_data()
-    uid = str(ctx.author.id)
-    horse = data["horses"].get(horse_id)
+    def op(data):
+        uid = str(ctx.author.id)
+        horse = data["horses"].get(horse_id)
     
-    if not horse or horse["owner"] != uid:
-        await ctx.reply("そのIDの馬は存在しないか、あなたの馬ではありません。")
-        return
+        if not horse or horse["owner"] != uid:
+            return "そのIDの馬は存在しないか、あなたの馬ではありません。"
     
-    horse["favorite"] = False
-    await save_data(data)
-    await ctx.reply(f"**{horse['name']}** のお気に入り登録を解除しました。`!massretire` の対象となります。")
+        horse["favorite"] = False
+        return f"**{horse['name']}** のお気に入り登録を解除しました。`!massretire` の対象となります。"
+
+    await ctx.reply(await mutate(op))
 
 
 @bot.command(name="myhorses", help="自分の馬一覧を表示します")
@@ -966,92 +3271,80 @@ async def myhorses(ctx):
         s = h["stats"]
         fav_icon = "⭐" if h.get("favorite", False) else " "
         
-        # レース出走回数を計算
-        race_count = len(h.get("history", []))
-
         lines.append(
-            f"{fav_icon} - {h['name']} (ID: {hid}) / 年齢:{h['age']} / **レース数:{race_count}** / 勝利:{h['wins']} / 疲労:{h['fatigue']} / "
+            f"{fav_icon} - {h['name']} (ID: {hid}) / 年齢:{h['age']} / **レース数:{race_count(h)}** / 勝利:{h['wins']} / 疲労:{h['fatigue']} / "
             f"SPD:{s['speed']} STA:{s['stamina']} TEM:{s['temper']} GRW:{s['growth']} / "
             f"芝:{s.get('turf_apt', 'N/A')} ダ:{s.get('dirt_apt', 'N/A')}" 
         )
-    await ctx.reply("\n".join(lines))
+    await reply_lines(ctx, lines)
 
 @bot.command(name="entry", help="本日のGⅠに出走登録します: 例) !entry H12345")
 async def entry(ctx, horse_id: str):
-    data = await load_data()
-    uid = str(ctx.author.id)
-    horse = data["horses"].get(horse_id)
-    if not horse:
-        await ctx.reply("そのIDの馬は存在しません。")
-        return
-    if horse["owner"] != uid:
-        await ctx.reply("これはあなたの馬ではありません。")
-        return
-    if horse.get("fatigue", 0) >= 8:
-        await ctx.reply("この馬は疲労が高すぎます。今週は休ませましょう。")
-        return
+    def op(data):
+        uid = str(ctx.author.id)
+        horse = data["horses"].get(horse_id)
+        if not horse:
+            return "そのIDの馬は存在しません。"
+        if horse["owner"] != uid:
+            return "これはあなたの馬ではありません。"
+        if horse.get("fatigue", 0) >= 8:
+            return "この馬は疲労が高すぎます。今週は休ませましょう。"
 
-    current_day = data["season"]["day"]
+        current_day = data["season"]["day"]
     
-    if current_day > MAX_G1_DAY:
-         await ctx.reply(f"本日({current_day}日)はGⅠ開催日ではないため、エントリーできません。")
-         return
+        if current_day > MAX_G1_DAY:
+             return f"本日({current_day}日)はGⅠ開催日ではないため、エントリーできません。"
          
-    pending = data.get("pending_entries", {})
-    day_key = str(current_day)
-    
-    if day_key not in pending:
-        pending[day_key] = []
+        book = entry_book(data)
+        day_key = str(current_day)
     
-    if horse_id in pending[day_key]:
-        await ctx.reply("すでに本日のレースにエントリー済みです。")
-        return
+        if book.contains(day_key, horse_id):
+            return "すでに本日のレースにエントリー済みです。"
 
-    owner_entries = [hid for hid in pending[day_key] if data['horses'].get(hid) and data['horses'][hid]['owner'] == uid]
-    if len(owner_entries) >= MAX_ENTRIES_PER_WEEK:
-         await ctx.reply(f"本日のエントリーは**{MAX_ENTRIES_PER_WEEK}頭**が上限です。すでに{len(owner_entries)}頭がエントリー済みです。")
-         return
+        owner_entries = book.owner_count(day_key, uid)
+        if owner_entries >= MAX_ENTRIES_PER_WEEK:
+             return f"本日のエントリーは**{MAX_ENTRIES_PER_WEEK}頭**が上限です。すでに{owner_entries}頭がエントリー済みです。"
 
 
-    pending[day_key].append(horse_id)
-    data["pending_entries"] = pending
-    await save_data(data)
+        book.add(day_key, horse_id)
+
+        return f"出走登録完了！ 本日(第{current_day}週)のGⅠに **{horse['name']}** をエントリーしました。"
 
-    await ctx.reply(f"出走登録完了！ 本日(第{current_day}週)のGⅠに **{horse['name']}** をエントリーしました。")
+    await ctx.reply(await mutate(op))
     
 # 【既存】出走登録取り消しコマンド
 @bot.command(name="unentry", help="本日のレースへの出走登録を取り消します: 例) !unentry H12345")
 async def unentry(ctx, horse_id: str):
-    data = await load_data()
-    uid = str(ctx.author.id)
-    horse = data["horses"].get(horse_id)
-    current_day = data["season"]["day"]
-    day_key = str(current_day)
+    def op(data):
+        uid = str(ctx.author.id)
+        horse = data["horses"].get(horse_id)
+        current_day = data["season"]["day"]
+        day_key = str(current_day)
 
-    if not horse:
-        await ctx.reply("そのIDの馬は存在しません。")
-        return
-    if horse["owner"] != uid:
-        await ctx.reply("これはあなたの馬ではありません。")
-        return
+        if not horse:
+            return "そのIDの馬は存在しません。"
+        if horse["owner"] != uid:
+            return "これはあなたの馬ではありません。"
         
-    pending = data.get("pending_entries", {})
+        book = entry_book(data)
     
-    if day_key not in pending or horse_id not in pending[day_key]:
-        await ctx.reply(f"**{horse['name']}** は本日(第{current_day}週)のレースにエントリーされていません。")
-        return
+        if not book.contains(day_key, horse_id):
+            return f"**{horse['name']}** は本日(第{current_day}週)のレースにエントリーされていません。"
         
-    # エントリーを取り消し
-    pending[day_key].remove(horse_id)
-    
-    # エントリーリストが空になったらキー自体を削除
-    if not pending[day_key]:
-         del pending[day_key]
+        # エントリーを取り消し（空になった日はキーごと削除される）
+        book.remove(day_key, horse_id)
 
-    data["pending_entries"] = pending
-    await save_data(data)
-    
-    await ctx.reply(f"✅ **{horse['name']}** の本日(第{current_day}週)のレースへの出走登録を取り消しました。")
+        # 出走しない馬の馬券は的中しないため、購入者に全額返還する
+        refunds = withdraw_horse(bet_pool(data, day_key), horse_id) if day_key in data.get("bets", {}) else {}
+        for bettor, amount in refunds.items():
+            adjust_owner(data, bettor, balance=amount)
+
+        message = f"✅ **{horse['name']}** の本日(第{current_day}週)のレースへの出走登録を取り消しました。"
+        if refunds:
+            message += f"\nこの馬を含む馬券 {len(refunds)}人分・計{sum(refunds.values())} を返還しました。"
+        return message
+
+    await ctx.reply(await mutate(op))
 
 @bot.command(name="schedule", help="本日と翌日のGⅠレーススケジュールを表示します")
 async def schedule(ctx):
@@ -1098,25 +3391,31 @@ async def schedule(ctx):
 
 @bot.command(name="entryfav", help="お気に入り馬を本日のGⅠに一括登録します")
 async def entryfav(ctx):
-    data = await load_data()
     uid = str(ctx.author.id)
-    owner_horses = data["owners"].get(uid, {}).get("horses", [])
+
+    def op(data):
+        owner_horses = data["owners"].get(uid, {}).get("horses", [])
     
-    # お気に入り馬のみを抽出
-    favorite_horses = [
-        hid for hid in owner_horses 
-        if data["horses"].get(hid) and data["horses"][hid].get("favorite", False)
-    ]
+        # お気に入り馬のみを抽出
+        favorite_horses = [
+            hid for hid in owner_horses 
+            if data["horses"].get(hid) and data["horses"][hid].get("favorite", False)
+        ]
     
-    await _perform_bulk_entry(ctx, data, favorite_horses, "お気に入り")
+        return _perform_bulk_entry(data, uid, favorite_horses, "お気に入り")
+
+    await ctx.reply(await mutate(op))
 
 @bot.command(name="entryall", help="全頭を本日のGⅠに一括登録します（疲労8未満）")
 async def entryall(ctx):
-    data = await load_data()
     uid = str(ctx.author.id)
-    all_horses = data["owners"].get(uid, {}).get("horses", [])
+
+    def op(data):
+        all_horses = data["owners"].get(uid, {}).get("horses", [])
     
-    await _perform_bulk_entry(ctx, data, all_horses, "全頭")
+        return _perform_bulk_entry(data, uid, all_horses, "全頭")
+
+    await ctx.reply(await mutate(op))
 
 @bot.command(name="entries", help="本日のGⅠレースの出馬表を表示します")
 async def entries(ctx):
@@ -1139,144 +3438,142 @@ async def entries(ctx):
         )
         return
 
-    entries_list = data.get("pending_entries", {}).get(current_day_str, [])
+    book = entry_book(data)
+    entries_list = book.entries(current_day_str)
     if not entries_list:
         await ctx.reply(
             f"本日のGⅠ「**{race_info['name']}**」にエントリーされている馬はいません。"
         )
         return
 
-    entries_data = []
-    post_position = 1
+    cache_key = ("entries", current_year, current_month, current_day_str, book.version(current_day_str))
 
-    for hid in entries_list:
-        horse = data["horses"].get(hid)
-        if not horse or horse["owner"] == BOT_OWNER_ID:
-            continue
+    async def build():
+        entries_data = []
+        post_position = 1
 
-        try:
-            user = bot.get_user(int(horse["owner"])) or await bot.fetch_user(int(horse["owner"]))
-            owner_name = user.display_name
-        except:
-            owner_name = "不明"
-
-        entries_data.append([
-            post_position,
-            hid,
-            cut_horse_name(horse["name"]),
-            owner_name,
-            horse.get("fatigue", 0),
-            horse.get("wins", 0),
-        ])
-        post_position += 1
-
-    if not entries_data:
-        await ctx.reply("本日のGⅠにエントリーされているプレイヤー馬はいません。")
-        return
+        names = await NAMES.resolve_many(
+            data["horses"][hid]["owner"] for hid in entries_list
+            if hid in data["horses"] and data["horses"][hid]["owner"] != BOT_OWNER_ID
+        )
 
-    ascii_table = t2a(
-        header=["馬番", "ID", "馬名", "オーナー", "疲労", "勝利"],
-        body=entries_data,
-        style=PresetStyle.thin_compact
-    )
+        for hid in entries_list:
+            horse = data["horses"].get(hid)
+            if not horse or horse["owner"] == BOT_OWNER_ID:
+                continue
 
-    header_text = (
-        f"🏆 **{current_year}年{current_month}月 第{current_day}週 GⅠ出馬表**\n"
-        f"{race_info['name']} / {race_info['distance']}m / {race_info['track']}\n"
-    )
+            owner_name = names.get(horse["owner"]) or "不明"
+
+            entries_data.append([
+                post_position,
+                hid,
+                cut_horse_name(horse["name"]),
+                owner_name,
+                horse.get("fatigue", 0),
+                horse.get("wins", 0),
+            ])
+            post_position += 1
+
+        if not entries_data:
+            return ["本日のGⅠにエントリーされているプレイヤー馬はいません。"]
+
+        pages = table_pages(["馬番", "ID", "馬名", "オーナー", "疲労", "勝利"], entries_data)
+
+        header_lines = [
+            f"🏆 **{current_year}年{current_month}月 第{current_day}週 GⅠ出馬表**",
+            f"{race_info['name']} / {race_info['distance']}m / {race_info['track']}",
+        ]
+        return header_lines + pages
 
-    await ctx.reply(header_text + "```" + ascii_table + "```")
+    # 同じ表示は使い回し、同時に要求された場合も描画は1回にまとめる
+    await reply_lines(ctx, await RENDERED.render(cache_key, build))
 
 @bot.command(name="rest", help="馬を休養させて疲労を回復します（1日1回）: 例) !rest H12345")
 async def rest(ctx, horse_id: str):
-    data = await load_data()
-    uid = str(ctx.author.id)
-    horse = data["horses"].get(horse_id)
-    current_day = data["season"]["day"]
+    def op(data):
+        uid = str(ctx.author.id)
+        horse = data["horses"].get(horse_id)
+        current_day = data["season"]["day"]
     
-    if not horse:
-        await ctx.reply("そのIDの馬は存在しません。")
-        return
-    if horse["owner"] != uid:
-        await ctx.reply("これはあなたの馬ではありません。")
-        return
+        if not horse:
+            return "そのIDの馬は存在しません。"
+        if horse["owner"] != uid:
+            return "これはあなたの馬ではありません。"
     
-    # ----------------- 1日1回制限チェック -----------------
-    if horse.get("rest_used_day") == current_day:
-        await ctx.reply(f"**{horse['name']}** は本日(第{current_day}週)既に休養しています。1日に1回までしか休養できません。")
-        return
-    # ---------------------------------------------------
+        # ----------------- 1日1回制限チェック -----------------
+        if horse.get("rest_used_day") == current_day:
+            return f"**{horse['name']}** は本日(第{current_day}週)既に休養しています。1日に1回までしか休養できません。"
+        # ---------------------------------------------------
 
-    old = horse.get("fatigue", 0)
-    horse["fatigue"] = max(0, old - 3)
-    horse["rest_used_day"] = current_day 
-    await save_data(data)
-    await ctx.reply(f"**{horse['name']}** を休養させました。疲労 {old} → {horse['fatigue']}")
+        old = horse.get("fatigue", 0)
+        horse["fatigue"] = max(0, old - 3)
+        horse["rest_used_day"] = current_day 
+        horse_index(data).update(horse)
+        return f"**{horse['name']}** を休養させました。疲労 {old} → {horse['fatigue']}"
+
+    await ctx.reply(await mutate(op))
 
 @bot.command(name="train", help="GRWを消費してステータスを恒久的に強化します: 例) !train H12345 speed 3")
 async def train(ctx, horse_id: str, stat_name: str, amount: int):
-    data = await load_data()
-    uid = str(ctx.author.id)
-    horse = data["horses"].get(horse_id)
+    def op(data):
+        uid = str(ctx.author.id)
+        horse = data["horses"].get(horse_id)
     
-    # 1. 馬の存在とオーナー権限のチェック
-    if not horse or horse["owner"] != uid:
-        await ctx.reply("そのIDの馬は存在しないか、あなたの馬ではありません。")
-        return
-
-    # 2. ステータス名のチェックと変換
-    stat_name = stat_name.lower()
-    allowed_stats_map = {
-        "speed": "speed", "spd": "speed",
-        "stamina": "stamina", "sta": "stamina",
-        "temper": "temper", "tem": "temper",
-        "turf": "turf_apt", "芝": "turf_apt",
-        "dirt": "dirt_apt", "ダート": "dirt_apt"
-    }
+        # 1. 馬の存在とオーナー権限のチェック
+        if not horse or horse["owner"] != uid:
+            return "そのIDの馬は存在しないか、あなたの馬ではありません。"
+
+        # 2. ステータス名のチェックと変換
+        stat_key = stat_name.lower()
+        allowed_stats_map = {
+            "speed": "speed", "spd": "speed",
+            "stamina": "stamina", "sta": "stamina",
+            "temper": "temper", "tem": "temper",
+            "turf": "turf_apt", "芝": "turf_apt",
+            "dirt": "dirt_apt", "ダート": "dirt_apt"
+        }
     
-    if stat_name not in allowed_stats_map:
-        await ctx.reply("⚠️ **エラー**: 強化できるステータスは `speed`, `stamina`, `temper`, `turf`(芝), `dirt`(ダート) のいずれかです。")
-        return
+        if stat_key not in allowed_stats_map:
+            return "⚠️ **エラー**: 強化できるステータスは `speed`, `stamina`, `temper`, `turf`(芝), `dirt`(ダート) のいずれかです。"
         
-    target_stat = allowed_stats_map[stat_name]
+        target_stat = allowed_stats_map[stat_key]
 
-    # 3. 消費量のチェック
-    if not (1 <= amount <= MAX_TRAIN_AMOUNT):
-        await ctx.reply(f"⚠️ **エラー**: 消費するGRWの量は1から{MAX_TRAIN_AMOUNT}ポイントの間で指定してください。")
-        return
+        # 3. 消費量のチェック
+        if not (1 <= amount <= MAX_TRAIN_AMOUNT):
+            return f"⚠️ **エラー**: 消費するGRWの量は1から{MAX_TRAIN_AMOUNT}ポイントの間で指定してください。"
 
-    # 4. GRWの残高チェック
-    current_grw = horse["stats"].get("growth", 0)
-    if current_grw < amount:
-        await ctx.reply(f"⚠️ **エラー**: **{horse['name']}** の現在のGRWは {current_grw} です。{amount}ポイントを消費するにはGRWが不足しています。")
-        return
+        # 4. GRWの残高チェック
+        current_grw = horse["stats"].get("growth", 0)
+        if current_grw < amount:
+            return f"⚠️ **エラー**: **{horse['name']}** の現在のGRWは {current_grw} です。{amount}ポイントを消費するにはGRWが不足しています。"
         
-    # 5. 実行
-    
-    # GRW消費 
-    horse["stats"]["growth"] = max(0, current_grw - amount) 
+        # 5. 実行
     
-    # ステータス増加 (変換レート1:1)
-    amount_to_add = amount * GRW_CONVERSION_RATE 
+        # GRW消費 
+        horse["stats"]["growth"] = max(0, current_grw - amount) 
     
-    old_stat_value = horse["stats"].get(target_stat, 0)
-    new_stat_value = min(100, old_stat_value + amount_to_add)
+        # ステータス増加 (変換レート1:1)
+        amount_to_add = amount * GRW_CONVERSION_RATE 
     
-    horse["stats"][target_stat] = new_stat_value
+        old_stat_value = horse["stats"].get(target_stat, 0)
+        new_stat_value = min(100, old_stat_value + amount_to_add)
     
-    # 疲労増加
-    old_fatigue = horse.get("fatigue", 0)
-    horse["fatigue"] = min(10, old_fatigue + 1)
+        horse["stats"][target_stat] = new_stat_value
     
-    await save_data(data)
+        # 疲労増加
+        old_fatigue = horse.get("fatigue", 0)
+        horse["fatigue"] = min(10, old_fatigue + 1)
+        horse_index(data).update(horse)
     
-    # 6. 結果報告
-    await ctx.reply(
-        f"✅ **{horse['name']}** を調教しました！\n"
-        f"消費GRW: **{amount}** (残り: {horse['stats']['growth']})\n"
-        f"強化ステータス: **{target_stat.upper().replace('_APT', '').replace('TURF', '芝').replace('DIRT', 'ダート')}** {old_stat_value} → **{new_stat_value}**\n"
-        f"疲労が1ポイント増加しました ({old_fatigue} → {horse['fatigue']})"
-    )
+        # 6. 結果報告
+        return (
+            f"✅ **{horse['name']}** を調教しました！\n"
+            f"消費GRW: **{amount}** (残り: {horse['stats']['growth']})\n"
+            f"強化ステータス: **{target_stat.upper().replace('_APT', '').replace('TURF', '芝').replace('DIRT', 'ダート')}** {old_stat_value} → **{new_stat_value}**\n"
+            f"疲労が1ポイント増加しました ({old_fatigue} → {horse['fatigue']})"
+        )
+
+    await ctx.reply(await mutate(op))
 
 
 @bot.command(name="balance", help="所持賞金と勝利数を確認します")
@@ -1286,50 +3583,64 @@ async def balance(ctx):
     owner = data["owners"].get(uid, {"balance": 0, "wins": 0})
     await ctx.reply(f"賞金: {owner['balance']} / 勝利数: {owner['wins']}")
 
-@bot.command(name="rank", help="ランキング表示（賞金・勝利）")
-async def rank(ctx, category: str = "prize"):
+RANK_BUILDS = Coalescer()
+
+@bot.command(name="rank", help="ランキング表示（賞金・勝利）: 例) !rank prize 2 / !rank wins 1 season / !rank prize 1 2025-04")
+async def rank(ctx, category: str = "prize", page: int = 1, scope: str = "all"):
     data = await load_data()
 
-    if category not in ["prize", "wins"]:
+    if category not in RANK_CATEGORIES:
         await ctx.reply("カテゴリは 'prize' か 'wins' を指定してください。例) `!rank prize`")
         return
 
+    if page < 1:
+        await ctx.reply("ページは1以上を指定してください。")
+        return
+
+    # 集計期間: all（通算） / season（今シーズン） / YYYY-MM（集計のあるシーズン）
+    if scope == "all":
+        season = None
+        period = ""
+    else:
+        season = season_id(data) if scope == "season" else scope
+        if season != season_id(data) and season not in data.get("rankings", {}):
+            await ctx.reply(f"'{scope}' の集計はありません。期間は `all` / `season` / 集計のあるシーズン（例: 2025-04）を指定してください。")
+            return
+        period = f"（{season} シーズン）"
+
+    board = leaderboards(data).board(category, season)
+    sorted_board = board.page(page)
+    total_pages = (len(board) + RANK_PAGE_SIZE - 1) // RANK_PAGE_SIZE
+
     if category == "prize":
-        board = {}
-        for uid, o in data["owners"].items():
-            if uid == BOT_OWNER_ID: continue
-            board[uid] = o.get("balance", 0)
-        
-        title = "👑 賞金ランキング 👑"
-        sorted_board = sorted(board.items(), key=lambda item: item[1], reverse=True)[:10]
-
-    else: # wins
-        board = {}
-        for uid, o in data["owners"].items():
-            if uid == BOT_OWNER_ID: continue
-            board[uid] = o.get("wins", 0)
-            
-        title = "🏆 勝利数ランキング 🏆"
-        sorted_board = sorted(board.items(), key=lambda item: item[1], reverse=True)[:10]
+        title = f"👑 賞金ランキング{period} 👑"
+    else:
+        title = f"🏆 勝利数ランキング{period} 🏆"
 
-    # ランキング表示の整形
-    rank_lines = [title, "----------------------------"]
-    
-    for i, (uid, value) in enumerate(sorted_board):
-        try:
-            user = bot.get_user(int(uid)) or await bot.fetch_user(int(uid))
-            name = user.display_name
-        except:
-            name = "引退したオーナー"
+    if not sorted_board:
+        await ctx.reply(f"{title}\n該当するオーナーがいません。")
+        return
 
-        if category == "prize":
-            value_str = f"{value:,}円"
-        else:
-            value_str = f"{value}勝"
-            
-        rank_lines.append(f"**{i+1}位.** {name} ({value_str})")
+    async def build():
+        # ランキング表示の整形
+        rank_lines = [f"{title} ({page}/{total_pages}ページ)", "----------------------------"]
 
-    await ctx.reply("\n".join(rank_lines))
+        names = await NAMES.resolve_many(uid for _, uid, _ in sorted_board)
+
+        for position, uid, value in sorted_board:
+            name = names.get(uid) or "引退したオーナー"
+
+            if category == "prize":
+                value_str = f"{value:,}円"
+            else:
+                value_str = f"{value}勝"
+
+            rank_lines.append(f"**{position}位.** {name} ({value_str})")
+        return rank_lines
+
+    # 同じページが同時に要求された場合は、表示名の解決と整形を1回にまとめる
+    key = (category, season, page, total_pages, tuple(sorted_board))
+    await ctx.reply("\n".join(await RANK_BUILDS.run(key, build)))
 
 
 # ----------------- タスクスケジューラ -----------------
@@ -1343,9 +3654,20 @@ async def pre_announce_task():
 async def before_pre_announce_task():
     await bot.wait_until_ready()
 
+@tasks.loop(seconds=LOOP_LAG_INTERVAL)
+async def loop_lag_task():
+    # 一定時間だけ眠り、予定より遅れて起きた分をイベントループの遅延として記録する
+    loop = asyncio.get_running_loop()
+    expected = loop.time() + LOOP_LAG_PROBE
+    await asyncio.sleep(LOOP_LAG_PROBE)
+    lag = max(0.0, loop.time() - expected)
+    LOOP_LAG_SAMPLES.append(lag)
+    METRICS.observe("racing_event_loop_lag_seconds", lag)
+    METRICS.set("racing_event_loop_lag_last_seconds", lag)
+
 @tasks.loop(time=RACE_TIME_JST)
 async def race_task():
-    await run_race_and_advance_day()
+    await run_scheduled_races()
 
 @race_task.before_loop
 async def before_race_task():
@@ -1371,7 +3693,7 @@ async def check_and_announce_race():
         await channel.send(f"🏇 **【レース告知】** ⏱️ 本日（第{current_day}週）はGⅠレースの開催はありませんが、定刻に日付更新と下級レースを行います。")
         return
         
-    entries_count = len(data.get("pending_entries", {}).get(current_day_str, []))
+    entries_count = entry_book(data).count(current_day_str)
     
     if entries_count == 0:
         await channel.send(
@@ -1388,95 +3710,301 @@ async def check_and_announce_race():
         )
 
 
+def settle_race(data, field, results, race_info, day_key):
+    """
+    着順が決まったレースの精算内容を計算する（状態はまだ変更しない）。
+    返り値:
+      horses  {馬ID: 更新するフィールドと値}（疲労・成長・勝利数・出走回数・獲得賞金）
+      owners  {オーナーID: [所持金の増減, 勝利数の増減]}（賞金と馬券の払い戻しの合計）
+      history 履歴ストアに追記する [(馬ID, 出走番号, 履歴dict), ...]
+    """
+    season = data["season"]
+    horses = {}
+    owners = {}
+    history = []
+
+    for r in results:
+        owner_id = r["owner"]
+        if owner_id == BOT_OWNER_ID:
+            continue
+        horse = field.get(r["horse_id"])
+        if horse is None:
+            # 着順確定後に引退・削除された馬
+            continue
+        won = 1 if r["pos"] == 1 else 0
+
+        # 疲労増加とレース後のGRW成長（コピー上で計算する）
+        grown = {"stats": dict(horse["stats"])}
+        progress_growth(grown)
+        number = race_count(horse) + 1
+        horses[r["horse_id"]] = {
+            "fatigue": min(10, horse.get("fatigue", 0) + 2),
+            "stats": grown["stats"],
+            "wins": horse.get("wins", 0) + won,
+            "race_count": number,
+            "prize_total": horse.get("prize_total", 0) + r["prize"],
+        }
+
+        delta = owners.setdefault(owner_id, [0, 0])
+        delta[0] += r["prize"]
+        delta[1] += won
+
+        history.append((r["horse_id"], number, {
+            "race": race_info["name"],
+            "pos": r["pos"],
+            "prize": r["prize"],
+            "day": season["day"],
+            "year": season["year"],
+            "month": season["month"],
+            "score": round(r["score"], 2)
+        }))
+
+    # 馬券の払い戻し
+    if day_key in data.get("bets", {}):
+        for uid, payout in settle_bets(as_pool(data["bets"][day_key]), results).items():
+            owners.setdefault(uid, [0, 0])[0] += payout
+
+    return {"horses": horses, "owners": owners, "history": history}
+
+def apply_settlement(data, settlement, day_key, is_g1):
+    """
+    settle_race() の結果を状態に反映する。途中で await しないため、
+    他の処理から反映途中の状態が見えることはない。
+    """
+    index = horse_index(data)
+    for hid, changes in settlement["horses"].items():
+        horse = data["horses"][hid]
+        horse.update(changes)
+        index.update(horse)
+
+    for uid, (balance, wins) in settlement["owners"].items():
+        adjust_owner(data, uid, balance=balance, wins=wins)
+
+    # 処理が完了したエントリーと賭け情報をクリア（コレクションは差し替えず、索引を保つ）
+    if is_g1:
+        entry_book(data).clear_day(day_key)
+    data.get("bets", {}).pop(day_key, None)
+
 async def run_race_and_advance_day():
-    data = await load_data()
+    """現在の日付でレースを1回実行して日付を進める（!forcerace 用。日次の実施記録には数えない）"""
+    # レース処理中にコマンドによる変更が割り込まないようにする
+    async with STATE_LOCK:
+        await STATE.flush()
+        data = await load_data()
+        await _run_races(data, [None])
+    await publish_pending_runs()
+
+
+async def run_scheduled_races(now=None):
+    """
+    定時レースの実施記録（journal）を見て、未実施の開催日の分だけレースを行う。
+    同じ開催日を二重に処理することはなく、停止中に過ぎた開催日はまとめて実施する。
+    """
+    now = now or datetime.now(JST)
+    async with STATE_LOCK:
+        await STATE.flush()
+        data = await load_data()
+        journal = data["journal"]
+        latest = latest_race_date(now)
+
+        if journal["last_run"] is None:
+            # 実施記録がない（導入直後）。直近の開催日までは実施済みとして扱う
+            journal["last_run"] = latest.isoformat()
+            await STATE.flush()
+            return
+
+        due = []
+        run_date = date.fromisoformat(journal["last_run"]) + timedelta(days=1)
+        while run_date <= latest:
+            due.append(run_date.isoformat())
+            run_date += timedelta(days=1)
+
+        if len(due) > MAX_CATCHUP_DAYS:
+            print(f"Skipping {len(due) - MAX_CATCHUP_DAYS} missed race days older than {MAX_CATCHUP_DAYS} days")
+            due = due[-MAX_CATCHUP_DAYS:]
+
+        if due or journal["runs"]:
+            await _run_races(data, due)
+    await publish_pending_runs()
+
+
+def latest_race_date(now):
+    """now 時点で開催時刻を過ぎている最新の日付（JST）"""
+    today = now.astimezone(JST).date()
+    if now.astimezone(JST).time() >= RACE_TIME_JST.replace(tzinfo=None):
+        return today
+    return today - timedelta(days=1)
+
+
+async def _run_races(data, run_dates):
+    """
+    レースを journal に記録しながら実行する。
+    各レースは pending（受付）→ scored（着順確定）→ settled（精算済み）→ advanced（日付更新済み）の順に進む。
+    複数日分でも状態への反映は await を挟まずに行い、保存は1回にまとめる。
+    そのため保存される journal には、精算と日付更新まで反映し終えたレースだけが載る。
+    告知は保存後に STATE_LOCK の外で行い（publish_pending_runs）、告知が済むまで journal に残すので、
+    停止しても次回告知をやり直せる。
+    """
+    global LAST_RACE_RUN
+    journal = data["journal"]
+    runs = journal["runs"]
+    claimed = {run["run_date"] for run in runs}
+    for run_date in run_dates:
+        if run_date is None or run_date not in claimed:
+            runs.append({"run_date": run_date, "stage": "pending"})
+        if run_date is not None and run_date > (journal["last_run"] or ""):
+            journal["last_run"] = run_date
+
+    for run in runs:
+        try:
+            advance_run(data, run)
+        except Exception as e:
+            # 途中まで反映した精算を保存すると、再開時に二重に反映される。
+            # 今回の変更（受付した journal を含む）はすべて捨て、保存済みの状態から次回やり直す
+            print(f"Race run {run['run_date']} failed at stage '{run['stage']}', discarding changes: {e}")
+            METRICS.inc("racing_race_failures_total", stage=run["stage"])
+            STATE.reset()
+            return
+
+    with METRICS.timer("racing_race_stage_seconds", stage="commit"):
+        await STATE.flush()
+
+    done = [run for run in runs if run["stage"] == "advanced"]
+    # 引退馬の履歴は、引退が保存されてから削除する
+    for run in done:
+        for horse_id, _ in run["retired"]:
+            HISTORY.discard(horse_id)
+    if done:
+        LAST_RACE_RUN = datetime.now(JST)
+
+
+async def publish_pending_runs():
+    """
+    保存済みで未告知（advanced）のレースを告知し、journal から外す。
+    告知の送信中は STATE_LOCK を持たないので、その間もコマンドは待たされない。
+    """
+    async with PUBLISH_LOCK:
+        async with STATE_LOCK:
+            data = await load_data()
+            done = [run for run in data["journal"]["runs"] if run["stage"] == "advanced"]
+        if not done:
+            return
+
+        with METRICS.timer("racing_race_stage_seconds", stage="publish"):
+            await publish_runs(data, done)
+
+        async with STATE_LOCK:
+            # 告知中に状態が読み直されていてもよいように、同じ内容の記録を探して外す
+            runs = (await load_data())["journal"]["runs"]
+            for run in done:
+                if run in runs:
+                    runs.remove(run)
+            await STATE.flush()
+
+
+def advance_run(data, run):
+    """journal の1件を、記録された段階から advanced まで進める（同期処理）"""
+    if run["stage"] == "pending":
+        with METRICS.timer("racing_race_stage_seconds", stage="score"):
+            run["race"] = score_race(data)
+        run["stage"] = "scored"
+
+    if run["stage"] == "scored":
+        started = perf_counter()
+        race = run["race"]
+        history = []
+        if race and race["results"]:
+            day_key = str(race["day"])
+            settlement = settle_race(data, data["horses"], race["results"], race, day_key)
+            apply_settlement(data, settlement, day_key, race["is_g1"])
+            history = settlement["history"]
+        run["history"] = history
+        run["stage"] = "settled"
+        METRICS.observe("racing_race_stage_seconds", perf_counter() - started, stage="settle")
+
+    if run["stage"] == "settled":
+        with METRICS.timer("racing_race_stage_seconds", stage="advance"):
+            run["retired"] = advance_season(data)
+        run["stage"] = "advanced"
+
+
+def score_race(data):
+    """
+    現在の日付のレースの出走馬を決めて着順を確定する（状態は変更しない）。
+    告知チャンネルがない場合は None（レースを行わない）、出走馬がいない場合は results が空のレースを返す。
+    """
     current_day = data["season"]["day"]
-    current_month = data["season"]["month"]
-    current_year = data["season"]["year"]
     current_day_str = str(current_day)
     channel_id = data["announce_channel"]
 
     if not channel_id:
         print("Announce channel not set. Skipping race execution.")
-        await advance_day(data)
-        return
+        return None
 
-    channel = bot.get_channel(channel_id)
-    if not channel:
+    if not bot.get_channel(channel_id):
         print(f"Channel with ID {channel_id} not found. Skipping race execution.")
-        await advance_day(data)
-        return
+        return None
 
     race_info = data["schedule"].get(current_day_str)
-    
+
     is_g1 = bool(race_info)
-    
-    race_info = {"name": "下級レース", "distance": random.choice([1200, 1600, 2000, 2400]), "track": random.choice(["芝", "ダート"])}
-    entries_list = []
-    # 下級レースでは、疲労が少ない全ての馬が自動でエントリーされる（疲労2未満）
-    for hid, horse in data["horses"].items():
-        if horse["owner"] != BOT_OWNER_ID and horse.get("fatigue", 0) < 2:
-            entries_list.append(hid)
+
+    if not is_g1:
+        race_info = {"name": "下級レース", "distance": random.choice([1200, 1600, 2000, 2400]), "track": random.choice(["芝", "ダート"])}
+        # 下級レースでは、疲労が少ない全ての馬が自動でエントリーされる（疲労2未満）
+        entries_list = get_lower_race_entries(data, current_day_str)
     else:
         # GⅠがある日
-        entries_list = data.get("pending_entries", {}).get(current_day_str, [])
-        
-        # GⅠの出走頭数が少ない場合、Bot馬を補充
-        if len(entries_list) < MIN_G1_FIELD:
-            for _ in range(MIN_G1_FIELD - len(entries_list)):
-                bot_horse = generate_bot_horse(data["horses"])
-                data["horses"][bot_horse["id"]] = bot_horse
-                entries_list.append(bot_horse["id"])
+        entries_list = list(entry_book(data).entries(current_day_str))
+
+    race = {
+        "year": data["season"]["year"],
+        "month": data["season"]["month"],
+        "day": current_day,
+        "name": race_info["name"],
+        "distance": race_info["distance"],
+        "track": race_info["track"],
+        "is_g1": is_g1,
+        "results": [],
+    }
 
+    # 出走馬一覧（Bot馬はこのレース限りの存在で、data["horses"]には保存しない）
+    field = {hid: data["horses"][hid] for hid in entries_list if hid in data["horses"]}
+
+    # GⅠの出走頭数が少ない場合、Bot馬を補充
+    if is_g1 and len(field) < MIN_G1_FIELD:
+        for _ in range(MIN_G1_FIELD - len(field)):
+            bot_horse = generate_bot_horse(field)
+            field[bot_horse["id"]] = bot_horse
+
+    entries_list = list(field)
 
-    
     if not entries_list:
-        if is_g1:
-            await channel.send(f"本日(第{current_day}週)のGⅠ「**{race_info['name']}**」は、出走馬がいなかったためレースは中止されました。")
-        else:
-             await channel.send(f"本日(第{current_day}週)の下級レースは、出走可能な馬がいなかったため中止されました。")
-             
-        await advance_day(data)
-        return
+        return race
 
 
     # ------------------ レース実行ロジック ------------------
-    
-    all_entries = []
+
     # 馬番をランダムに割り振るためにシャッフル
-    random.shuffle(entries_list) 
-    
-    post_position = 1
-    for horse_id in entries_list:
-        horse = data["horses"].get(horse_id)
-        if not horse:
-            continue
-            
-        score = calc_race_score(horse, race_info["distance"], race_info["track"])
-        
-        all_entries.append({
-            "horse_id": horse_id,
-            "horse_name": horse["name"],
-            "owner": horse["owner"],
-            "score": score,
-            "post_position": post_position
-        })
-        post_position += 1
-        
-        # 疲労増加と年齢上昇の準備
-        if horse["owner"] != BOT_OWNER_ID:
-            horse["fatigue"] = min(10, horse.get("fatigue", 0) + 2)
-            progress_growth(horse)
-            # レース後のGRWバフの効果は即時反映されるため、個別の記録は不要
-            
-    # スコアでソートし、順位を決定
-    all_entries.sort(key=lambda x: x["score"], reverse=True)
-    
-    winner_id = all_entries[0]["horse_id"]
-    
-    results = []
+    random.shuffle(entries_list)
+
+    # 全頭のスコアと着順をまとめて計算（疲労はレース前の値を使う）
+    with METRICS.timer("racing_race_score_seconds"):
+        scores, order = score_field(
+            field_stats(field[hid] for hid in entries_list), race_info["distance"], race_info["track"]
+        )
+    all_entries = [
+        {
+            "horse_id": entries_list[i],
+            "horse_name": field[entries_list[i]]["name"],
+            "owner": field[entries_list[i]]["owner"],
+            "score": float(scores[i]),
+            "post_position": int(i) + 1
+        }
+        for i in order
+    ]
+
    # レース名に応じて賞金プールを決定
-    prize_config = prize_pool_for_g1(race_info['name'])
     if is_g1:
         prize_config = prize_pool_for_g1(race_info["name"])
     else:
@@ -1485,155 +4013,186 @@ async def run_race_and_advance_day():
             50000,
             [0.5, 0.3, 0.2]  # 1～3着
         )
-    
+
     for i, entry in enumerate(all_entries):
         pos = i + 1
         prize = 0
         if pos <= len(prize_config[1]):
             prize = int(prize_config[0] * prize_config[1][i])
-        
+
         entry["pos"] = pos
         entry["prize"] = prize
-        results.append(entry)
-        
-        # 賞金と勝利数の更新
-        owner_id = entry["owner"]
-        if owner_id != BOT_OWNER_ID:
-            if owner_id not in data["owners"]:
-                data["owners"][owner_id] = {"horses": [], "balance": 0, "wins": 0}
+        race["results"].append(entry)
+
+    return race
 
-            data["owners"][owner_id]["balance"] = data["owners"][owner_id].get("balance", 0) + prize
-            
-            if pos == 1:
-                data["horses"][entry["horse_id"]]["wins"] = data["horses"][entry["horse_id"]].get("wins", 0) + 1
-                data["owners"][owner_id]["wins"] = data["owners"][owner_id].get("wins", 0) + 1
-                
-        # レース履歴の追加
-        if entry["owner"] != BOT_OWNER_ID:
-             data["horses"][entry["horse_id"]]["history"].append({
-                 "race": race_info["name"],
-                 "pos": pos,
-                 "prize": prize,
-                 "day": current_day,
-                 "year": current_year,
-                 "month": current_month
-             })
-
-    # 処理例
-    bets = data.get("bets", {}).get(current_day_str, {})
-    
-    winner_id = results[0]["horse_id"]
-
-    bets_today = data.get("bets", {}).get(current_day_str, {})
-    for uid, b in bets_today.items():
-        if b["horse_id"] == winner_id:
-            payout = int(b["amount"] * b["odds"])
-            owner = get_owner(data, uid)
-            owner["balance"] += payout
-
-    # 賭け情報をクリア
-    data["bets"] = {}
-
-    # ------------------ 結果告知とデータ更新 ------------------
-    await announce_race_results(data, race_info, results, current_day, current_month, current_year, channel, len(entries_list))
-    
-    # 処理が完了したエントリーリストをクリア
-    if is_g1 and current_day_str in data["pending_entries"]:
-        del data["pending_entries"][current_day_str] 
-
-    # ベットもクリア
-    if current_day_str in data.get("bets", {}):
-        del data["bets"][current_day_str]
-    
-    # 日付を進める
-    await advance_day(data)
+
+async def publish_runs(data, runs):
+    """保存が済んだレースの履歴・結果アーカイブへの追記と告知を行う"""
+    channel_id = data.get("announce_channel")
+    channel = bot.get_channel(channel_id) if channel_id else None
+    # 停止中の分をまとめて処理した場合は、結果を1通の要約にまとめる
+    catch_up = len(runs) > 1
+    summary = []
+    retired_names = []
+
+    for run in runs:
+        race = run["race"]
+        retired_names.extend(name for _, name in run["retired"])
+        if not race:
+            continue
+
+        if not race["results"]:
+            if catch_up:
+                summary.append(f"{race['year']}年{race['month']}月 第{race['day']}週 【{race['name']}】 出走馬なしのため中止")
+            elif channel and race["is_g1"]:
+                await send_lines(channel, [f"本日(第{race['day']}週)のGⅠ「**{race['name']}**」は、出走馬がいなかったためレースは中止されました。"])
+            elif channel:
+                await send_lines(channel, [f"本日(第{race['day']}週)の下級レースは、出走可能な馬がいなかったため中止されました。"])
+            continue
+
+        # 引退済みの馬の履歴は追記しない（履歴ストアからは削除済み）
+        try:
+            await HISTORY.append([entry for entry in run["history"] if entry[0] in data["horses"]])
+        except Exception as e:
+            print(f"Failed to store race history: {e}")
+
+        # レース結果をアーカイブに追記（状態には保持しない）
+        try:
+            await RESULTS.append({
+                "year": race["year"],
+                "month": race["month"],
+                "day": race["day"],
+                "name": race["name"],
+                "distance": race["distance"],
+                "track": race["track"],
+                "results": [
+                    {
+                        "pos": r["pos"],
+                        "post_position": r["post_position"],
+                        "horse_id": r["horse_id"],
+                        "horse_name": r["horse_name"],
+                        "owner": r["owner"],
+                        "prize": r["prize"],
+                        "score": round(r["score"], 2),
+                    }
+                    for r in race["results"]
+                ],
+            })
+        except Exception as e:
+            print(f"Failed to archive race results: {e}")
+
+        if catch_up:
+            winner = race["results"][0]
+            summary.append(
+                f"{race['year']}年{race['month']}月 第{race['day']}週 【{race['name']}】 "
+                f"1着 **{winner['horse_name']}** ({len(race['results'])}頭立て)"
+            )
+        elif channel:
+            await announce_race_results(data, race, race["results"], race["day"], race["month"], race["year"],
+                                        channel, len(race["results"]))
+
+    if summary and channel:
+        await send_lines(channel, [f"⏩ **停止中に開催日を迎えた{len(runs)}日分のレースをまとめて実施しました**"] + summary)
+
+    if retired_names:
+        await announce_retirements(data, retired_names)
+
+
+async def announce_retirements(data, retired_names):
+    channel_id = data.get("announce_channel")
+    if channel_id:
+         channel = bot.get_channel(channel_id)
+         if channel:
+             await send_lines(channel, [
+                 f"🚨 **引退通知**: 本日、規定により以下の**{len(retired_names)}頭**の競走馬が引退しました。",
+                 f"引退馬: {', '.join(retired_names)}"
+             ])
+         else:
+             print(f"Warning: Announce channel with ID {channel_id} not found.")
 
 
 async def advance_day(data):
     """日付を1日進める処理（自動引退チェックを含む）"""
-    
+    retired = advance_season(data)
+
+    # 引退馬の履歴削除と告知（引退の反映を保存してから）
+    if retired:
+        await STATE.flush()
+        for horse_id, _ in retired:
+            HISTORY.discard(horse_id)
+        await announce_retirements(data, [name for _, name in retired])
+
+    await save_data(data)
+
+
+def advance_season(data):
+    """
+    日付を1日進め、自動引退させた馬の [(馬ID, 馬名), ...] を返す。
+    同期処理で、保存・履歴の削除・告知は呼び出し側で行う。
+    """
+
     # シーズンを進行
     current_day = data["season"]["day"]
     current_month = data["season"]["month"]
     current_year = data["season"]["year"]
-    
+
     new_day = current_day + 1
     new_month = current_month
     new_year = current_year
-    
+
     # 30日でシーズン終了
     if new_day > 30:
         new_day = 1
         new_month += 1
-        
+
     if new_month > 12:
         new_month = 1
         new_year += 1
-        
+
     data["season"]["day"] = new_day
     data["season"]["month"] = new_month
     data["season"]["year"] = new_year
-    
-    horses_to_retire_info = [] # Stores (horse_id, owner_id, horse_name)
 
-    # 全馬の rest_used_day をリセットし、引退チェック
-    for horse_id, horse in list(data["horses"].items()): # イテレーション中に削除するためコピーを使用
-        
-        if horse["owner"] == BOT_OWNER_ID:
-            # Bot馬は引退させない
-            continue
+    horses_to_retire_info = [] # Stores (horse_id, owner_id, horse_name)
+    index = horse_index(data)
 
+    # 休養した馬だけ rest_used_day をリセット（Bot馬は索引に含まれない）
+    for horse_id in list(index.rested_ids()):
+        horse = data["horses"][horse_id]
         horse["rest_used_day"] = -1
-        
-        # 馬齢の更新 (シーズン開始日: 1月1日に固定)
-        if new_month == 1 and new_day == 1:
-             horse["age"] += 1
+        index.update(horse)
 
-        # --- 自動引退チェック ---
-        should_retire = False
-        
-        # 1. 50レース出走
-        race_count = len(horse.get("history", []))
-        if race_count >= 50:
-            should_retire = True
-            
-        # 2. 6歳以上
-        if horse.get("age", 0) >= 6:
-            should_retire = True
+    # 馬齢の更新 (シーズン開始日: 1月1日に固定)
+    if new_month == 1 and new_day == 1:
+        for horse_id in list(index.player_ids()):
+            horse = data["horses"][horse_id]
+            horse["age"] += 1
+            index.update(horse)
+
+    # --- 自動引退チェック ---
+    # 50レース出走 または 6歳以上 の馬は索引で管理済み（Bot馬は引退させない）
+    for horse_id in sorted(index.retire_due_ids()):
+        horse = data["horses"][horse_id]
+        horses_to_retire_info.append((horse_id, horse["owner"], horse["name"]))
 
-        if should_retire:
-            horses_to_retire_info.append((horse_id, horse["owner"], horse["name"]))
 
-    
     # 実際の引退処理
-    retired_names = []
+    retired = []
+    # pending_entriesから馬IDをまとめて削除
+    entry_book(data).remove_horses([info[0] for info in horses_to_retire_info])
     for horse_id, owner_id, horse_name in horses_to_retire_info:
-        # pending_entriesから馬IDを削除
-        _clean_pending_entry(data, horse_id) 
-        
         if owner_id in data["owners"] and horse_id in data["owners"][owner_id]["horses"]:
             data["owners"][owner_id]["horses"].remove(horse_id)
-        
+
         # data["horses"]から削除
         if horse_id in data["horses"]:
             del data["horses"][horse_id]
-            retired_names.append(horse_name)
-
-    # 引退馬の告知
-    if retired_names:
-        channel_id = data.get("announce_channel")
-        if channel_id:
-             channel = bot.get_channel(channel_id)
-             if channel:
-                 await channel.send(
-                     f"🚨 **引退通知**: 本日、規定により以下の**{len(retired_names)}頭**の競走馬が引退しました。\n"
-                     f"引退馬: {', '.join(retired_names)}"
-                 )
-             else:
-                 print(f"Warning: Announce channel with ID {channel_id} not found.")
+            index.remove(horse_id)
+            retired.append((horse_id, horse_name))
 
-    await save_data(data)
     print(f"Date advanced to: {new_year}/{new_month}/{new_day}")
+    return retired
 
 
 # 起動
@@ -1647,6 +4206,24 @@ async def on_ready():
     if not race_task.is_running():
         race_task.start()
 
+    if not loop_lag_task.is_running():
+        loop_lag_task.start()
+
+    global STATE_COMPACTED
+    if not STATE_COMPACTED:
+        STATE_COMPACTED = True
+        removed = await mutate(compact_state)
+        if removed:
+            print(f"Compacted racing data: removed {removed} orphaned records")
+        moved = await migrate_legacy_races()
+        if moved:
+            print(f"Moved {moved} legacy race results to the archive")
+        moved = await migrate_legacy_history()
+        if moved:
+            print(f"Moved race history of {moved} horses to the history store")
+        # 停止中に中断・未実施になった定時レースを処理する
+        await run_scheduled_races()
+
 if __name__ == "__main__":
-    threading.Thread(target=run_flask, daemon=True).start()
+    connect_storage()
     bot.run(os.environ["DISCORD_TOKEN"])
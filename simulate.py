@@ -0,0 +1,198 @@
+"""
+オフラインのシーズンシミュレーター / ベンチマーク
+
+Discord・Supabase・19:00 の定時タスクを使わずに
+run_race_and_advance_day() を繰り返し実行し、
+処理時間・データサイズの増え方・経済指標を表示する。
+
+    python simulate.py --owners 50 --horses 5 --seasons 12 --seed 1
+"""
+
+import io
+import json
+import time
+import random
+import asyncio
+import argparse
+import contextlib
+import statistics
+
+import numpy as np
+
+import main
+
+
+def _store_size():
+    """ストレージ全体の (バイト数, 行数)"""
+    rows = main.STORAGE.scan("")
+    return sum(len(json.dumps(value, ensure_ascii=False).encode()) for _, value in rows), len(rows)
+
+
+# ---------------- Discord のスタブ ----------------
+
+class _Author:
+    def __init__(self, uid):
+        self.id = uid
+        self.display_name = f"owner{uid}"
+
+
+class _Context:
+    def __init__(self, uid):
+        self.author = _Author(uid)
+
+    async def reply(self, message):
+        pass
+
+
+class _Channel:
+    """送信内容は捨て、件数とバイト数だけ数える"""
+
+    id = 1
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+
+    async def send(self, message):
+        self.messages += 1
+        self.bytes += len(message.encode())
+
+
+async def _command(name, uid, *args):
+    await main.bot.get_command(name).callback(_Context(uid), *args)
+
+
+# ---------------- シミュレーション ----------------
+
+def _state_bytes():
+    return sum(len(value.encode()) for value in main.split_rows(main.STATE.data).values())
+
+
+def _economy(data):
+    balances = [o.get("balance", 0) for uid, o in data["owners"].items() if uid != main.BOT_OWNER_ID]
+    if not balances:
+        return {"total": 0, "mean": 0, "median": 0, "max": 0}
+    return {
+        "total": sum(balances),
+        "mean": statistics.mean(balances),
+        "median": statistics.median(balances),
+        "max": max(balances),
+    }
+
+
+def _random_ticket(entries):
+    """(馬ID, 券種, 2頭目) をランダムに選ぶ"""
+    bet_type = random.choice(list(main.BET_TYPES)) if len(entries) >= 2 else "win"
+    first, second = random.sample(entries, 2) if bet_type == "quinella" else (random.choice(entries), None)
+    return first, bet_type, second
+
+
+async def simulate(owners, horses, seasons, bet_rate, verbose=False):
+    channel = _Channel()
+    main.bot.get_channel = lambda channel_id: channel
+
+    data = await main.load_data()
+    data["announce_channel"] = channel.id
+
+    owner_ids = list(range(1, owners + 1))
+    races = 0
+    bets = 0
+    started = time.perf_counter()
+    race_seconds = 0.0
+
+    print(f"{'season':>6} {'days':>5} {'races/s':>8} {'horses':>7} {'state KB':>9} {'store KB':>9} "
+          f"{'balance mean':>13} {'median':>9} {'max':>10}")
+
+    for season in range(1, seasons + 1):
+        season_started = time.perf_counter()
+        for _ in range(30):
+            data = await main.load_data()
+            day = data["season"]["day"]
+
+            # 同じ時間帯のコマンドはまとめて投げ、ライタータスクのバッチに乗せる
+            await asyncio.gather(*(
+                _command("newhorse", uid, f"S{uid}-{n}")
+                for uid in owner_ids
+                for n in range(len(data["owners"].get(str(uid), {}).get("horses", [])), horses)
+            ))
+
+            # 疲れた馬は休ませ、残りは全頭エントリーを試みる（上限超過分はコマンド側で断られる）
+            owned = [(int(h["owner"]), hid, h.get("fatigue", 0))
+                     for hid, h in data["horses"].items() if h["owner"] != main.BOT_OWNER_ID]
+            await asyncio.gather(*(_command("rest", uid, hid) for uid, hid, fatigue in owned if fatigue >= 8))
+            if day <= main.MAX_G1_DAY:
+                await asyncio.gather(*(_command("entry", uid, hid) for uid, hid, fatigue in owned if fatigue < 8))
+                entries = list(main.entry_book(data).entries(str(day)))
+                day_bets = [
+                    _command("bet", uid, first, max(1, owner["balance"] // 10), bet_type, second)
+                    for uid in owner_ids
+                    for owner in [data["owners"].get(str(uid), {})]
+                    if entries and owner.get("balance", 0) > 0 and random.random() < bet_rate
+                    for first, bet_type, second in [_random_ticket(entries)]
+                ]
+                await asyncio.gather(*day_bets)
+                bets += len(day_bets)
+
+            # 派生索引はレースの精算をまたいで使い回されるはず（作り直すと全オーナー・全馬の走査になる）
+            board = main.leaderboards(data).board("prize")
+            index = main.horse_index(data)
+
+            t = time.perf_counter()
+            if verbose:
+                await main.run_race_and_advance_day()
+            else:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    await main.run_race_and_advance_day()
+            race_seconds += time.perf_counter() - t
+            races += 1
+
+            data = await main.load_data()
+            if main.leaderboards(data).board("prize") is not board or main.horse_index(data) is not index:
+                raise RuntimeError(f"Derived indexes were rebuilt by the race on day {day}")
+
+        data = await main.load_data()
+        economy = _economy(data)
+        elapsed = time.perf_counter() - season_started
+        store_bytes, _ = _store_size()
+        print(f"{season:>6} {races:>5} {30 / elapsed:>8.1f} {len(data['horses']):>7} "
+              f"{_state_bytes() / 1024:>9.1f} {store_bytes / 1024:>9.1f} "
+              f"{economy['mean']:>13,.0f} {economy['median']:>9,.0f} {economy['max']:>10,}")
+
+    await main.STATE.flush()
+    wall = time.perf_counter() - started
+    print()
+    print(f"wall time       : {wall:.2f}s")
+    print(f"races           : {races} ({races / wall:.1f} races/s, race step {race_seconds / races * 1000:.2f} ms avg)")
+    print(f"bets placed     : {bets}")
+    print(f"messages sent   : {channel.messages} ({channel.bytes / 1024:.1f} KB)")
+    print(f"state size      : {_state_bytes() / 1024:.1f} KB in {len(main.split_rows(main.STATE.data))} rows")
+    store_bytes, store_rows = _store_size()
+    print(f"storage         : {main.STORAGE.backend.__class__.__name__}, {store_bytes / 1024:.1f} KB in {store_rows} rows")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="競馬Botのオフラインシミュレーター")
+    parser.add_argument("--owners", type=int, default=20, help="オーナー数")
+    parser.add_argument("--horses", type=int, default=main.MAX_HORSES_PER_OWNER, help="オーナーあたりの保有頭数")
+    parser.add_argument("--seasons", type=int, default=3, help="シミュレーションするシーズン（30日）の数")
+    parser.add_argument("--bet-rate", type=float, default=0.5, help="GⅠ開催日に各オーナーが賭ける確率")
+    parser.add_argument("--storage", choices=["memory", "sqlite"], default="memory",
+                        help="保存先（sqlite の場合は SQLITE_PATH のファイル）")
+    parser.add_argument("--seed", type=int, default=None, help="乱数シード（指定すると結果が再現できる）")
+    parser.add_argument("--batch-window", type=float, default=0.0,
+                        help="ライタータスクのバッチ待ち時間（秒）。本番は %s" % main.BATCH_WINDOW_SECONDS)
+    parser.add_argument("--verbose", action="store_true", help="レース処理中のログも表示する")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+        main.RACE_RNG = np.random.default_rng(args.seed)
+        main.ODDS = main.OddsEngine(rng=np.random.default_rng(args.seed + 1))
+    main.BATCH_WINDOW_SECONDS = args.batch_window
+    # 送信先はスタブなので、チャンネルごとの送信間隔の調整は行わない
+    main.SENDER = main.MessageSender(window=0)
+    main.connect_storage(args.storage)
+    asyncio.run(simulate(args.owners, args.horses, args.seasons, args.bet_rate, args.verbose))
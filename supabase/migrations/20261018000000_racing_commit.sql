@@ -0,0 +1,24 @@
+-- 状態の保存（SupabaseStorage.commit）で使う関数。
+-- rev_key の行が {"rev": expected} のときだけ、行の書き込み・削除と
+-- リビジョンの expected + 1 への更新を1トランザクションで行い true を返す。
+-- 他のプロセスが先にリビジョンを進めていた場合は何も書かずに false を返す。
+
+create table if not exists kv_store (
+  key text primary key,
+  value jsonb not null
+);
+
+create or replace function racing_commit(rev_key text, expected bigint, upserts jsonb, deletes text[])
+returns boolean language plpgsql as $$
+begin
+  update kv_store set value = jsonb_build_object('rev', expected + 1)
+   where key = rev_key and (value->>'rev')::bigint = expected;
+  if not found then
+    return false;
+  end if;
+  insert into kv_store (key, value)
+    select e.key, e.value from jsonb_each(upserts) as e
+    on conflict (key) do update set value = excluded.value;
+  delete from kv_store where key = any(deletes);
+  return true;
+end $$;